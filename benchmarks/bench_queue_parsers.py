@@ -0,0 +1,76 @@
+"""Time the scheduler queue parsers on recorded outputs.
+
+Recorded `squeue` and `showq --xml` outputs are generated in a temporary directory (or read from --recorded,
+where `squeue.txt` and `showq.xml` are looked for), then each parser runs --repeat times.
+
+    python benchmarks/bench_queue_parsers.py --jobs 10000
+"""
+import argparse
+import random
+import sys
+import tempfile
+import time
+from os import environ
+from os.path import abspath, dirname, exists, join
+
+environ.setdefault('TASKMAN_CKPTS', tempfile.gettempdir())
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from taskman import MoabScheduler, SlurmScheduler  # noqa: E402
+
+
+def make_ids(n_jobs, rng):
+    return [str(4000000 + i) if rng.random() < 0.8 else '{}_{}'.format(3000000 + i // 100, i % 100)
+            for i in range(n_jobs)]
+
+
+def record_squeue(ids, rng):
+    lines = ['{}|{}'.format(job_id, rng.choice(['R', 'R', 'PD', 'CG'])) for job_id in ids]
+    return '\n'.join(lines) + '\n'
+
+
+def record_showq(ids, rng):
+    queues = {'active': [], 'eligible': [], 'blocked': []}
+    for i, job_id in enumerate(ids):
+        option = rng.choice(['active', 'active', 'eligible', 'blocked'])
+        queues[option].append('<job AWDuration="{}" Class="gpu" JobID="{}" JobName="task{}" MasterHost="node{}" '
+                              'PAL="cluster" ReqAWDuration="86400" ReqProcs="8" RsvStartTime="0" '
+                              'StartPriority="1" StartTime="0" State="Running" SubmissionTime="0" '
+                              'User="user"></job>'.format(rng.randrange(86400), job_id, i, i % 500))
+    return '<Data><Object>queue</Object><cluster LocalActiveNodes="500"></cluster>' + ''.join(
+        '<queue count="{}" option="{}">{}</queue>'.format(len(jobs), option, ''.join(jobs))
+        for option, jobs in queues.items()) + '</Data>'
+
+
+def bench(fn, arg, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        times.append(time.perf_counter() - start)
+    return min(times), len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--recorded', help='directory with squeue.txt and showq.xml')
+    args = parser.parse_args()
+
+    recorded = args.recorded or tempfile.mkdtemp()
+    rng = random.Random(0)
+    ids = make_ids(args.jobs, rng)
+    for name, record in [('squeue.txt', record_squeue), ('showq.xml', record_showq)]:
+        if not exists(join(recorded, name)):
+            with open(join(recorded, name), 'w') as f:
+                f.write(record(ids, rng))
+
+    for name, parse in [('squeue.txt', SlurmScheduler.parse_queue), ('showq.xml', MoabScheduler.parse_queue)]:
+        with open(join(recorded, name), 'r') as f:
+            output = f.read()
+        best, n_parsed = bench(parse, output, args.repeat)
+        print('{:<30} {:>8} jobs {:>10.2f} ms'.format(parse.__qualname__, n_parsed, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Measure submission throughput and refresh latency against the simulated scheduler.
+
+For each task count, a temporary $HOME gets a template whose jobs print a few !taskman lines and end. The tasks
+are submitted in one batch with TASKMAN_SCHEDULER=sim, then refreshed until they have all ended. The simulator
+settings (TASKMAN_SIM_*) are taken from the command line, so no cluster is needed.
+
+    python benchmarks/bench_scheduler.py --tasks 100 1000 --queue 10000 --output bench_scheduler.json
+"""
+import argparse
+import io
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from os import environ, makedirs
+from os.path import abspath, dirname
+
+from bench_taskman import git_commit
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+TEMPLATE = '''#!/bin/bash
+#SBATCH --job-name=$TASKMAN_NAME
+#SBATCH --output=logs/%x.o%j
+for i in 1 2 3; do echo '!taskman{"epoch": '$i', "args": "$TASKMAN_ARGS"}'; sleep 0.1; done
+'''
+POST_EXEC = 'echo "${TASKMAN_JOB_ID:-$SLURM_JOB_ID},$TASKMAN_NAME,ok" >> ~/taskman/finished\n'
+
+
+def run_tasks(n_tasks, deadline):
+    """Run in the worker process, with $HOME and the simulator settings in the environment"""
+    sys.path.insert(0, REPO_DIR)
+    from taskman import JobStatus, Taskman
+
+    results = {}
+    specs = [('bench', '--seed {}'.format(i), 'bench{}'.format(i % 20)) for i in range(n_tasks)]
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        jobs = Taskman.create_tasks(specs)
+        results['create'] = time.perf_counter() - start
+        start = time.perf_counter()
+        submitted = Taskman.submit_many(jobs)
+        results['submit'] = time.perf_counter() - start
+    results['submitted'] = len(submitted)
+    results['submit_rate'] = len(submitted) / results['submit']
+
+    refreshes = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < deadline:
+        refresh_start = time.perf_counter()
+        Taskman.queue_changed()
+        with redirect_stdout(io.StringIO()):
+            Taskman.update(resume_incomplete_tasks=False)
+        refreshes.append(time.perf_counter() - refresh_start)
+        if all(j.status in [JobStatus.Finished, JobStatus.Dead] for j in Taskman.jobs.values()):
+            break
+        time.sleep(0.5)
+    results['all_ended'] = time.perf_counter() - start
+    results['refreshes'] = len(refreshes)
+    results['refresh_avg'] = sum(refreshes) / len(refreshes)
+    results['refresh_max'] = max(refreshes)
+    results['statuses'] = {}
+    for j in Taskman.jobs.values():
+        results['statuses'][str(j.status)] = results['statuses'].get(str(j.status), 0) + 1
+    results['commands'] = {name: {'count': stats['count'], 'avg': stats['seconds'] / stats['count'],
+                                  'errors': stats['errors'], 'timeouts': stats['timeouts']}
+                           for name, stats in Taskman.metrics.commands.items()}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--delay', type=float, default=1, help='mean queue delay of a job, in seconds')
+    parser.add_argument('--slots', type=int, default=32, help='jobs running at once')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean duration of a scheduler command')
+    parser.add_argument('--errors', type=float, default=0, help='probability that a scheduler command fails')
+    parser.add_argument('--failures', type=float, default=0, help='probability that a job dies')
+    parser.add_argument('--queue', type=int, default=0, help='jobs of other workflows in the queue')
+    parser.add_argument('--arrays', action='store_true', help='submit as job arrays')
+    parser.add_argument('--deadline', type=float, default=600, help='seconds to wait for the jobs to end')
+    parser.add_argument('--output', default='bench_scheduler.json')
+    parser.add_argument('--worker', type=int, metavar='TASKS', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_tasks(args.worker, args.deadline)))
+        return
+
+    results = {}
+    for n_tasks in args.tasks:
+        home = tempfile.mkdtemp(prefix='taskman_bench_')
+        try:
+            makedirs(home + '/taskman')
+            makedirs(home + '/logs')
+            makedirs(home + '/script_moab')
+            with open(home + '/script_moab/bench.sh', 'w') as f:
+                f.write(TEMPLATE)
+            with open(home + '/script_moab/taskman_post_exec.sh', 'w') as f:
+                f.write(POST_EXEC)
+            env = dict(environ, HOME=home, TASKMAN_CKPTS=home + '/ckpt', TASKMAN_SCHEDULER='sim',
+                       TASKMAN_SCRIPTS=home + '/script_moab', TASKMAN_QUEUE_TTL='0',
+                       TASKMAN_SIM_DELAY=str(args.delay), TASKMAN_SIM_SLOTS=str(args.slots),
+                       TASKMAN_SIM_LATENCY=str(args.latency), TASKMAN_SIM_ERRORS=str(args.errors),
+                       TASKMAN_SIM_FAILURES=str(args.failures), TASKMAN_SIM_QUEUE=str(args.queue))
+            env.pop('TASKMAN_BUCKET', None)
+            env.pop('TASKMAN_METRICS', None)
+            if args.arrays:
+                env['TASKMAN_JOB_ARRAYS'] = '1'
+            else:
+                env.pop('TASKMAN_JOB_ARRAYS', None)
+            output = subprocess.check_output([sys.executable, abspath(__file__), '--deadline', str(args.deadline),
+                                              '--worker', str(n_tasks)], env=env)
+            results[n_tasks] = json.loads(output.decode().strip().split('\n')[-1])
+        finally:
+            shutil.rmtree(home)
+
+        r = results[n_tasks]
+        print('{} tasks'.format(n_tasks))
+        print('    submitted {} in {:.2f} s ({:.0f} tasks/s)'.format(r['submitted'], r['submit'], r['submit_rate']))
+        print('    all ended after {:.1f} s, {} refreshes, avg {:.0f} ms, max {:.0f} ms'.format(
+            r['all_ended'], r['refreshes'], r['refresh_avg'] * 1000, r['refresh_max'] * 1000))
+        print('    statuses', r['statuses'])
+
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(), 'python': platform.python_version(), 'date': time.strftime('%Y-%m-%d %H:%M'),
+                   'params': {k: v for k, v in vars(args).items() if k not in ['tasks', 'output', 'worker']},
+                   'results': results}, f, indent=2)
+    print('Results written to', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Time each stage of Taskman.update() on synthetic data.
+
+For each task count, a temporary $HOME is filled with a 'started' database, dead/finished files, log files
+containing !taskman lines and recorded squeue/showq outputs. The stages then run in a fresh process, so the
+module-level paths of taskman point to that $HOME. Results are written as JSON, to compare versions.
+
+    python benchmarks/bench_taskman.py --tasks 1000 10000 100000 --output bench_output.json
+"""
+import argparse
+import io
+import json
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from os import environ, makedirs
+from os.path import abspath, dirname
+
+from bench_queue_parsers import make_ids, record_showq, record_squeue
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+FILLER_LINE = 'epoch 12 | step 3456 | loss 0.123456 | lr 0.000100 | throughput 1234.5 samples/s\n'
+
+
+def make_report(rng):
+    return '!taskman' + json.dumps({'epoch': rng.randrange(100), 'val_acc': round(rng.random(), 4),
+                                    'loss': round(rng.random(), 4), 'time': time.time() - rng.randrange(86400)})
+
+
+def generate(home, n_tasks, n_logs, log_size, seed):
+    """Write the synthetic task database, logs and scheduler outputs. Returns the paths of the logs."""
+    rng = random.Random(seed)
+    makedirs(home + '/taskman/old')
+    makedirs(home + '/logs')
+    moab_ids = make_ids(n_tasks, rng)
+    live_ids = []
+    log_files = []
+    with open(home + '/taskman/started', 'w') as started, open(home + '/taskman/dead', 'w') as dead, \
+            open(home + '/taskman/finished', 'w') as finished:
+        for i, moab_id in enumerate(moab_ids):
+            name = 'sweep{}_lr{}'.format(i % 50, i % 7)
+            started.write('{:08d};{};{};template;--lr 0.{} --seed {}\n'.format(i, name, moab_id, i % 7, i))
+            r = rng.random()
+            if r < 0.6:
+                finished.write('{},{},{}\n'.format(moab_id, name, rng.choice(['ok', 'ok', 'cancel'])))
+            elif r < 0.7:
+                dead.write('{},{}\n'.format(moab_id, name))
+            elif r < 0.97:
+                live_ids.append(moab_id)  # The others are lost
+            if i < n_logs:
+                log_files.append(home + '/logs/' + name + '.o' + moab_id)
+
+    block = ''.join(FILLER_LINE if k % 50 else make_report(rng) + '\n' for k in range(1, 1001))
+    for log_file in log_files:
+        with open(log_file, 'w') as f:
+            for _ in range(max(1, log_size // len(block))):
+                f.write(block)
+
+    queue_ids = live_ids + make_ids(len(live_ids) // 10, rng)  # Plus jobs taskman does not know about
+    with open(home + '/squeue.txt', 'w') as f:
+        f.write(record_squeue(queue_ids, rng))
+    with open(home + '/showq.xml', 'w') as f:
+        f.write(record_showq(queue_ids, rng))
+    return log_files
+
+
+def run_stages(home, log_files, seed):
+    """Run in the worker process, with $HOME set to `home`"""
+    sys.path.insert(0, REPO_DIR)
+    import taskman
+    from taskman import Taskman
+
+    recorded = {}
+    for name in ['squeue.txt', 'showq.xml']:
+        with open(home + '/' + name, 'r') as f:
+            recorded[name] = f.read()
+    outputs = {'squeue': recorded['squeue.txt'], 'showq': recorded['showq.xml']}
+    Taskman.get_cmd_output = staticmethod(lambda args, timeout=20: outputs.get(args[0], ''))
+
+    results = {}
+
+    def timed(stage, fn, *args):
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            result = fn(*args)
+        results[stage] = time.perf_counter() - start
+        return result
+
+    timed('import_started', Taskman.get_db)
+    schedulers = {'moab': taskman.MoabScheduler(), 'slurm': taskman.SlurmScheduler()}
+    queues = {}
+    for name, scheduler in schedulers.items():
+        commands, parse, _ = scheduler.queue_commands([])
+        queues[name] = timed('get_{}_queue'.format(name), Taskman.run_queue_commands, commands, parse)
+    statuses = queues[taskman.SCHEDULER]
+    timed('sync_job_list (cold)', Taskman.sync_job_list, statuses)
+    timed('update_report', Taskman.update_report)
+    timed('show_status', Taskman.show_status)
+
+    # A refresh cycle later: a few logs have grown
+    rng = random.Random(seed)
+    for log_file in rng.sample(log_files, len(log_files) // 10):
+        with open(log_file, 'a') as f:
+            f.write(FILLER_LINE * 100 + make_report(rng) + '\n')
+    timed('sync_job_list (warm)', Taskman.sync_job_list, statuses)
+    timed('update_report (warm)', Taskman.update_report)
+    timed('show_status (warm)', Taskman.show_status)
+    timed('select', Taskman.select, 'sweep1* status=Finished val_acc>0.5 sort:-val_acc')
+
+    timed('_clean', taskman._clean)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--logs', type=int, default=200, help='number of tasks with a log file')
+    parser.add_argument('--log-size', type=int, default=1000000, help='bytes per log file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--worker', nargs=2, metavar=('HOME', 'LOG_LIST'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        home, log_list = args.worker
+        with open(log_list, 'r') as f:
+            log_files = f.read().split('\n')
+        print(json.dumps(run_stages(home, log_files, args.seed)))
+        return
+
+    results = {}
+    for n_tasks in args.tasks:
+        home = tempfile.mkdtemp(prefix='taskman_bench_')
+        try:
+            log_files = generate(home, n_tasks, min(args.logs, n_tasks), args.log_size, args.seed)
+            with open(home + '/logs.txt', 'w') as f:
+                f.write('\n'.join(log_files))
+            env = dict(environ, HOME=home, TASKMAN_CKPTS=home + '/ckpt', TASKMAN_USE_SLURM='1')
+            env.pop('TASKMAN_BUCKET', None)
+            env.pop('TASKMAN_SCHEDULER', None)
+            output = subprocess.check_output([sys.executable, abspath(__file__), '--seed', str(args.seed),
+                                              '--worker', home, home + '/logs.txt'], env=env)
+            results[n_tasks] = json.loads(output.decode().strip().split('\n')[-1])
+        finally:
+            shutil.rmtree(home)
+
+        print('{} tasks'.format(n_tasks))
+        for stage, seconds in results[n_tasks].items():
+            print('    {:<24} {:>10.1f} ms'.format(stage, seconds * 1000))
+
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(), 'python': platform.python_version(), 'date': time.strftime('%Y-%m-%d %H:%M'),
+                   'params': {'logs': args.logs, 'log_size': args.log_size, 'seed': args.seed},
+                   'results': results}, f, indent=2)
+    print('Results written to', args.output)
+
+
+if __name__ == '__main__':
+    main()
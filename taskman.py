@@ -1,23 +1,89 @@
 from glob import glob
+import asyncio
+import csv
+import bisect
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import fcntl
+import hashlib
+import heapq
 import json
+import mmap
+import random
+import select
+import struct
+import signal
+import socket
+import sys
+import threading
 import subprocess
 import inspect
 import time
 import shutil
 import math
+import re
+import sqlite3
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from xml.etree import ElementTree
 from enum import Enum
-from os import makedirs, environ as env_vars
+from os import O_CLOEXEC, O_NONBLOCK, chmod, fstat, getpid, kill, killpg, link, makedirs, read, rename, replace, \
+    stat, symlink, unlink, utime, environ as env_vars
 from os.path import expandvars
 from pathlib import Path
 
 HOMEDIR = expandvars('$HOME')
-DB_STARTED_TASKS = HOMEDIR + '/taskman/started'
+DB_STARTED_TASKS = HOMEDIR + '/taskman/started'  # Legacy flat file, imported once into DB_FILE
+DB_DEAD_TASKS = HOMEDIR + '/taskman/dead'  # Appended to by the jobs, imported incrementally
+DB_FINISHED_TASKS = HOMEDIR + '/taskman/finished'  # Idem
+DB_FILE = HOMEDIR + '/taskman/tasks.db'
 SCRIPTS_FOLDER = env_vars.get('TASKMAN_SCRIPTS', HOMEDIR + '/script_moab')  # Dir with your scripts. Contains /taskman
 CKPT_FOLDER = env_vars['TASKMAN_CKPTS']
+CKPT_STORE_FOLDER = CKPT_FOLDER + '/.store'  # Checkpoint files by content hash, shared by the jobs starting from them
+# Without reflinks, place checkpoints as hard links or symlinks to the read-only stored file instead of copies. The
+# jobs must then write new checkpoint files and rename them over the placed ones: rewriting one in place fails with
+# EACCES, or, for root, changes the checkpoint of every job sharing it.
+CKPT_LINKS = 'TASKMAN_CKPT_LINKS' in env_vars
 SLURM_MODE = 'TASKMAN_USE_SLURM' in env_vars
-MAX_LINES = env_vars.get('TASKMAN_MAXLINES', 30)
+SCHEDULER = env_vars.get('TASKMAN_SCHEDULER', 'slurm' if SLURM_MODE else 'moab')  # 'moab', 'slurm' or 'sim'
+MAX_LINES = int(env_vars.get('TASKMAN_MAXLINES', 30))  # Job rows per page
 BUCKET_FOLDER = env_vars.get('TASKMAN_BUCKET', None)
+BUCKET_BATCH = int(env_vars.get('TASKMAN_BUCKET_BATCH', 500))  # Bucket lines submitted per refresh
+BUCKET_SETTLE_TIME = 2  # Seconds without modification before a bucket file is claimed
+BUCKET_STALE_CLAIM = 3600  # Seconds without progress before a claim of another host is taken over
+RESULTS_FOLDER = HOMEDIR + '/taskman/results'  # Merged results.csv files and their statistics
+REFRESH_INTERVAL = int(env_vars.get('TASKMAN_REFRESH', 120))  # Seconds
+QUEUE_MIN_INTERVAL = int(env_vars.get('TASKMAN_QUEUE_MIN_INTERVAL', 30))  # Scheduler polling, while the queue changes
+QUEUE_MAX_INTERVAL = int(env_vars.get('TASKMAN_QUEUE_MAX_INTERVAL', 600))  # Scheduler polling, while it does not
+QUEUE_CACHE_FILE = HOMEDIR + '/taskman/queue_cache.json'  # Queue snapshot shared by all taskman processes
+QUEUE_CACHE_TTL = int(env_vars.get('TASKMAN_QUEUE_TTL', 30))  # Seconds before the scheduler is asked again
+WATCH_MODE = env_vars.get('TASKMAN_WATCH', 'auto')  # 'auto' (inotify + polling) or 'poll' (polling only)
+WATCH_POLL_INTERVAL = 5  # Seconds between stat() calls on the watched paths
+LOGS_MIN_INTERVAL = 10  # Running jobs write to their logs all the time: scan them at most this often
+FOLLOW_INTERVAL = 0.5  # Seconds between checks of the followed logs
+# Queue the next segment of tasks whose report asks for resubmission while they run, starting when they succeed
+CHAIN_MODE = 'TASKMAN_CHAIN' in env_vars
+MAX_QUEUED = int(env_vars.get('TASKMAN_MAX_QUEUED', 0))  # Cap on running + waiting jobs, 0 for none
+SUBMIT_WORKERS = int(env_vars.get('TASKMAN_SUBMIT_WORKERS', 8))  # Concurrent msub/sbatch calls
+SUBMIT_LEASE = 1800  # Seconds before the queued tasks claimed by a process that died are submitted by another one
+SUBMIT_ATTEMPTS = int(env_vars.get('TASKMAN_SUBMIT_ATTEMPTS', 5))  # Failed submissions of a task before giving up
+# Submit tasks sharing a template as one SLURM job array. The post exec script must then record the job as
+# $TASKMAN_JOB_ID (<array id>_<index>), because $SLURM_JOB_ID is a different id for array tasks.
+JOB_ARRAYS = 'TASKMAN_JOB_ARRAYS' in env_vars  # Ignored by schedulers without job arrays
+CANCEL_CHUNK = 200  # Job ids per scancel call
+QUEUE_MAX_IDS = 1000  # Above this many tracked jobs, list the whole user queue instead
+ACCOUNTING_CHUNK = 500  # Job ids per sacct call
+METRICS_FILE = env_vars.get('TASKMAN_METRICS', None)  # JSON lines file, one line per refresh
+METRICS_FOOTER = 'TASKMAN_METRICS_FOOTER' in env_vars
+REPORT_PREFIX = b'!taskman'
+LOG_BLOCK_SIZE = 64 * 1024
+# Report history, see SeriesStore. Off unless set: it reads the whole log of every task once more.
+SERIES_FOLDER = env_vars.get('TASKMAN_SERIES') or None
+SERIES_READ_SIZE = 1024 * 1024
 
 
 def fmt_time(seconds):
@@ -36,6 +102,8 @@ class JobStatus(Enum):
     Running = 'Running'
     Waiting = 'Waiting'
     Lost = 'Lost'
+    Pending = 'Pending'  # Not submitted yet, see Taskman.admit
+    Failed = 'Failed'  # Could not be submitted, see Taskman.admit
     Other = ''
 
     def __str__(self):
@@ -43,14 +111,17 @@ class JobStatus(Enum):
 
     @property
     def cancellable(self):
-        return self in [JobStatus.Running, JobStatus.Waiting]
+        return self in [JobStatus.Running, JobStatus.Waiting, JobStatus.Pending, JobStatus.Failed]
 
     @property
     def needs_attention(self):
-        return self in [JobStatus.Dead, JobStatus.Lost]
+        return self in [JobStatus.Dead, JobStatus.Lost, JobStatus.Failed]
 
 
 class Job(object):
+    __slots__ = ['task_id', 'moab_id', 'name', 'status', 'status_msg', 'template_file', 'args_str', 'report',
+                 'finish_msg', 'prev_moab_id', 'frozen']
+
     def __init__(self, task_id, name, moab_id, status, template_file, args_str):
         self.task_id = task_id
         self.moab_id = moab_id
@@ -62,6 +133,7 @@ class Job(object):
         self.report = {}
         self.finish_msg = ''
         self.prev_moab_id = ''
+        self.frozen = False  # Ended and its report is final
 
     @property
     def script_file(self):
@@ -75,281 +147,2256 @@ class Job(object):
         return script_path, script_file
 
 
+class TaskDB(object):
+    """SQLite task database (WAL mode) indexed by task_id, moab_id and name"""
+    schema = """
+        CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, name TEXT, moab_id TEXT, template_file TEXT,
+                                          args_str TEXT, rev INTEGER);
+        CREATE INDEX IF NOT EXISTS tasks_moab_id ON tasks (moab_id);
+        CREATE INDEX IF NOT EXISTS tasks_name ON tasks (name);
+        CREATE INDEX IF NOT EXISTS tasks_rev ON tasks (rev);
+        CREATE TABLE IF NOT EXISTS outcomes (moab_id TEXT PRIMARY KEY, dead INTEGER DEFAULT 0,
+                                             finished INTEGER DEFAULT 0, finish_msg TEXT DEFAULT '');
+        CREATE TABLE IF NOT EXISTS imports (path TEXT PRIMARY KEY, inode INTEGER, offset INTEGER);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS result_summaries (task_id TEXT PRIMARY KEY, stamp TEXT, summary TEXT);
+        CREATE TABLE IF NOT EXISTS pending (task_id TEXT PRIMARY KEY, priority INTEGER, enqueued REAL,
+                                            attempts INTEGER DEFAULT 0, next_try REAL DEFAULT 0, error TEXT);
+        CREATE TABLE IF NOT EXISTS chains (task_id TEXT PRIMARY KEY, parent_id TEXT, moab_id TEXT);
+        CREATE TABLE IF NOT EXISTS bucket_lines (file TEXT, line INTEGER, PRIMARY KEY (file, line));
+    """
+    task_columns = 't.task_id, t.name, t.moab_id, t.template_file, t.args_str, o.dead, o.finished, o.finish_msg'
+
+    def __init__(self, path):
+        # Used from worker threads in the event loop mode, which never access it concurrently
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.schema)
+        self.import_started_file(DB_STARTED_TASKS)
+
+    def begin(self):
+        """Start a write transaction and return the revision to stamp rows with"""
+        self.conn.execute('BEGIN IMMEDIATE')
+        rev = self.get_meta('rev') + 1
+        self.set_meta('rev', rev)
+        return rev
+
+    def data_version(self):
+        """Changes when another connection commits to the database, but not on the commits of this one"""
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def import_started_file(self, path):
+        """One-shot import of the legacy 'started' file. The file is renamed afterwards."""
+        try:
+            with open(path, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        rows = [l.strip().split(';') for l in lines if l.strip() != '']
+        with self.conn:
+            rev = self.begin()
+            self.conn.executemany('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)',
+                                  [tokens[:5] + [rev] for tokens in rows if len(tokens) >= 5])
+        try:
+            rename(path, path + '.imported')
+        except FileNotFoundError:
+            pass  # Another process imported it at the same time, with the same rows
+
+    def sync_outcomes(self):
+        """Import the lines appended to the dead and finished files since the last call"""
+        new_lines = []
+        for path in [DB_DEAD_TASKS, DB_FINISHED_TASKS]:
+            try:
+                st = stat(path)
+            except FileNotFoundError:
+                continue
+            row = self.conn.execute('SELECT inode, offset FROM imports WHERE path = ?', (path,)).fetchone()
+            offset = 0 if row is None or row[0] != st.st_ino or row[1] > st.st_size else row[1]
+            if offset == st.st_size:
+                continue
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(st.st_size - offset)
+            data = data[:data.rfind(b'\n') + 1]  # Leave a partially written line for next time
+            new_lines.append((path, st.st_ino, offset + len(data), data.decode('UTF-8', 'replace').split('\n')))
+        if not new_lines:
+            return
+
+        with self.conn:
+            rev = self.begin()
+            for path, inode, offset, lines in new_lines:
+                for l in lines:
+                    tokens = l.strip().split(',')
+                    if tokens[0] == '':
+                        continue
+                    if path == DB_DEAD_TASKS:
+                        self.mark_dead(tokens[0], rev)
+                    else:
+                        self.mark_finished(tokens[0], tokens[2] if len(tokens) > 2 else '', rev)
+                self.conn.execute('INSERT OR REPLACE INTO imports VALUES (?, ?, ?)', (path, inode, offset))
+
+    def mark_dead(self, moab_id, rev):
+        self.conn.execute('INSERT INTO outcomes (moab_id, dead) VALUES (?, 1) '
+                          'ON CONFLICT (moab_id) DO UPDATE SET dead = 1', (moab_id,))
+        self.conn.execute('UPDATE tasks SET rev = ? WHERE moab_id = ?', (rev, moab_id))
+
+    def mark_finished(self, moab_id, finish_msg, rev):
+        self.conn.execute('INSERT INTO outcomes (moab_id, finished, finish_msg) VALUES (?, 1, ?) '
+                          'ON CONFLICT (moab_id) DO UPDATE SET finished = 1, finish_msg = excluded.finish_msg',
+                          (moab_id, finish_msg))
+        self.conn.execute('UPDATE tasks SET rev = ? WHERE moab_id = ?', (rev, moab_id))
+
+    def add_started(self, jobs):
+        with self.conn:
+            rev = self.begin()
+            self.conn.executemany('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)',
+                                  [(j.task_id, j.name, j.moab_id, j.template_file, j.args_str, rev) for j in jobs])
+            self.conn.executemany('DELETE FROM pending WHERE task_id = ?', [(j.task_id,) for j in jobs])
+
+    def add_pending(self, jobs, priority, bucket_lines=()):
+        """Queue tasks for submission. Tasks that are queued already keep their place, unless their submission was
+        given up. The (file key, line number) pairs of the bucket lines they come from are added in the same
+        transaction, see BucketSpool."""
+        now = time.time()
+        with self.conn:
+            rev = self.begin()
+            self.conn.executemany('INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?) '
+                                  'ON CONFLICT (task_id) DO UPDATE SET rev = excluded.rev',
+                                  [(j.task_id, j.name, j.moab_id or '', j.template_file, j.args_str, rev)
+                                   for j in jobs])
+            self.conn.executemany('INSERT INTO pending (task_id, priority, enqueued) VALUES (?, ?, ?) '
+                                  'ON CONFLICT (task_id) DO UPDATE SET priority = excluded.priority, '
+                                  'enqueued = excluded.enqueued, attempts = 0, next_try = 0, error = NULL '
+                                  'WHERE next_try IS NULL', [(j.task_id, priority, now) for j in jobs])
+            self.conn.executemany('INSERT OR IGNORE INTO bucket_lines VALUES (?, ?)', bucket_lines)
+
+    def get_bucket_lines(self, key):
+        """Numbers of the lines of a bucket file that are done"""
+        return {r[0] for r in self.conn.execute('SELECT line FROM bucket_lines WHERE file = ?', (key,))}
+
+    def add_bucket_lines(self, entries):
+        """Record (file key, line number) pairs of bucket lines that are done"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR IGNORE INTO bucket_lines VALUES (?, ?)', entries)
+
+    def remove_bucket_lines(self, key):
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('DELETE FROM bucket_lines WHERE file = ?', (key,))
+
+    def get_chains(self):
+        """Pre-queued next segments, as {task_id: (moab_id of the current segment, moab_id of the next one)}"""
+        return {r[0]: (r[1], r[2]) for r in self.conn.execute('SELECT task_id, parent_id, moab_id FROM chains')}
+
+    def add_chains(self, entries):
+        """Record (task_id, parent_id, moab_id) entries"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR REPLACE INTO chains VALUES (?, ?, ?)', entries)
+
+    def remove_chains(self, task_ids):
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('DELETE FROM chains WHERE task_id = ?', [(task_id,) for task_id in task_ids])
+
+    def promote_chains(self, jobs):
+        """Make the next segments the current ones. Their moab_id must be set on the jobs already."""
+        with self.conn:
+            rev = self.begin()
+            self.conn.executemany('UPDATE tasks SET moab_id = ?, rev = ? WHERE task_id = ?',
+                                  [(j.moab_id, rev, j.task_id) for j in jobs])
+            self.conn.executemany('DELETE FROM chains WHERE task_id = ?', [(j.task_id,) for j in jobs])
+
+    def claim_pending(self, now, limit):
+        """Claim the queued tasks that may be submitted, by priority then age, so that no other taskman process
+        submits them too. A negative limit means no limit. The claim ends when the tasks are started or their
+        submission is retried, or after SUBMIT_LEASE seconds if the process dies meanwhile."""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            rows = self.conn.execute('SELECT t.task_id, t.name, t.moab_id, t.template_file, t.args_str FROM pending p '
+                                     'JOIN tasks t ON t.task_id = p.task_id WHERE p.next_try <= ? '
+                                     'ORDER BY p.priority DESC, p.enqueued LIMIT ?', (now, limit)).fetchall()
+            self.conn.executemany('UPDATE pending SET next_try = ? WHERE task_id = ?',
+                                  [(now + SUBMIT_LEASE, r[0]) for r in rows])
+        return rows
+
+    def count_pending(self):
+        return self.conn.execute('SELECT COUNT(*) FROM pending WHERE next_try IS NOT NULL').fetchone()[0]
+
+    def retry_pending(self, errors, now):
+        """Try failed submissions again later, waiting twice as long after each failure. `errors` maps task ids to
+        the error of their submission. After SUBMIT_ATTEMPTS failures, the submission of a task is given up: it
+        stays in the queue with its last error until it is queued again or removed. Returns the ids of the tasks
+        given up."""
+        with self.conn:
+            rev = self.begin()
+            self.conn.executemany('UPDATE pending SET attempts = attempts + 1, error = ?, next_try = CASE '
+                                  'WHEN attempts + 1 >= ? THEN NULL ELSE ? + MIN(?, ? * (1 << MIN(attempts, 16))) END '
+                                  'WHERE task_id = ?',
+                                  [(error, SUBMIT_ATTEMPTS, now, QUEUE_MAX_INTERVAL, QUEUE_MIN_INTERVAL, task_id)
+                                   for task_id, error in errors.items()])
+            given_up = [task_id for task_id in errors if self.conn.execute(
+                'SELECT next_try IS NULL FROM pending WHERE task_id = ?', (task_id,)).fetchone() == (1,)]
+            self.conn.executemany('UPDATE tasks SET rev = ? WHERE task_id = ?',
+                                  [(rev, task_id) for task_id in given_up])  # They leave the Pending status
+        return given_up
+
+    def remove_pending(self, task_ids):
+        """Take tasks off the submission queue. Tasks that were never submitted are deleted."""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('DELETE FROM pending WHERE task_id = ?', [(task_id,) for task_id in task_ids])
+            self.conn.executemany("DELETE FROM tasks WHERE task_id = ? AND moab_id = ''",
+                                  [(task_id,) for task_id in task_ids])
+            self.set_meta('generation', self.generation() + 1)
+
+    def add_finished(self, entries):
+        """Record (moab_id, finish_msg) pairs"""
+        with self.conn:
+            rev = self.begin()
+            for moab_id, finish_msg in entries:
+                self.mark_finished(moab_id, finish_msg, rev)
+
+    def changed_since(self, rev):
+        """Return the current revision and the tasks stamped after `rev`, with their outcome, whether they are
+        queued for submission and the error of their submission if it was given up"""
+        cur_rev = self.get_meta('rev')
+        rows = self.conn.execute('SELECT ' + self.task_columns + ', p.next_try IS NOT NULL, '
+                                 'CASE WHEN p.next_try IS NULL THEN p.error END FROM tasks t '
+                                 'LEFT JOIN outcomes o ON o.moab_id = t.moab_id '
+                                 'LEFT JOIN pending p ON p.task_id = t.task_id '
+                                 'WHERE t.rev > ? AND t.rev <= ? ORDER BY t.name', (rev, cur_rev)).fetchall()
+        return cur_rev, rows
+
+    def generation(self):
+        """Bumped when tasks are removed, which changed_since cannot tell: readers must then reload everything"""
+        return self.get_meta('generation')
+
+    def get_results(self, task_ids):
+        """Cached summaries of results.csv files, as {task_id: (stamp, JSON summary)}"""
+        rows = []
+        for i in range(0, len(task_ids), 500):  # SQLite limits the number of query parameters
+            chunk = task_ids[i:i + 500]
+            rows += self.conn.execute('SELECT task_id, stamp, summary FROM result_summaries WHERE task_id IN ({})'
+                                      .format(','.join('?' * len(chunk))), chunk).fetchall()
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+    def set_results(self, entries):
+        """Cache (task_id, stamp, JSON summary) entries"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR REPLACE INTO result_summaries VALUES (?, ?, ?)', entries)
+
+    def remove(self, task_ids=None, clean_all=False):
+        """Remove tasks that are dead, finished or could not be submitted (all tasks if clean_all), among task_ids if
+        given. Returns the removed rows, followed by the moab_id of the pre-queued next segment of the task, if
+        any."""
+        query = ('SELECT ' + self.task_columns + ', c.moab_id FROM tasks t'
+                 ' LEFT JOIN outcomes o ON o.moab_id = t.moab_id LEFT JOIN chains c ON c.task_id = t.task_id')
+        if not clean_all:
+            query += (' WHERE (o.dead OR o.finished) AND t.task_id NOT IN (SELECT task_id FROM pending)'
+                      ' OR t.task_id IN (SELECT task_id FROM pending WHERE next_try IS NULL)')
+
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            rows = self.conn.execute(query).fetchall()
+            if task_ids is not None:
+                rows = [r for r in rows if r[0] in task_ids]
+            self.conn.executemany('DELETE FROM tasks WHERE task_id = ?', [(r[0],) for r in rows])
+            self.conn.executemany('DELETE FROM outcomes WHERE moab_id = ?', [(r[2],) for r in rows])
+            self.conn.executemany('DELETE FROM result_summaries WHERE task_id = ?', [(r[0],) for r in rows])
+            self.conn.executemany('DELETE FROM pending WHERE task_id = ?', [(r[0],) for r in rows])
+            self.conn.executemany('DELETE FROM chains WHERE task_id = ?', [(r[0],) for r in rows])
+            self.set_meta('generation', self.generation() + 1)
+        return rows
+
+
+class Metrics(object):
+    """Wall time of the refresh phases, latency of the scheduler commands and bytes read from the logs"""
+    buckets = [0.1, 0.5, 1, 2, 5, 10, 20, float('inf')]  # Upper bounds of the latency histogram, in seconds
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()  # Commands run in worker threads
+        self.phases = {}
+        self.log_bytes = 0
+        self.last_phases = {}
+        self.last_log_bytes = 0
+        self.commands = {}  # Cumulative, unlike the phases and log bytes of a refresh
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def record_command(self, args, seconds, outcome):
+        """outcome is 'ok', 'error' or 'timeout'"""
+        with self.lock:
+            stats = self.commands.setdefault(args[0], {'count': 0, 'seconds': 0.0, 'errors': 0, 'timeouts': 0,
+                                                       'histogram': [0] * len(self.buckets)})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            if outcome != 'ok':
+                stats[outcome + 's'] += 1
+            stats['histogram'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def flush(self):
+        """Append the metrics of this refresh to the metrics file, if any, as one JSON line"""
+        if not self.phases:
+            return
+        self.last_phases, self.phases = self.phases, {}
+        self.last_log_bytes, self.log_bytes = self.log_bytes, 0
+        if self.path is None:
+            return
+        with self.lock:
+            commands = {name: dict(stats, histogram=dict(zip([str(b) for b in self.buckets], stats['histogram'])))
+                        for name, stats in self.commands.items()}
+        record = {'time': round(time.time(), 3), 'phases': self.last_phases, 'log_bytes': self.last_log_bytes,
+                  'commands': commands}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def footer(self):
+        parts = ['refresh {:.1f}s ({})'.format(sum(self.last_phases.values()), ', '.join(
+            '{} {:.1f}s'.format(name, seconds) for name, seconds in self.last_phases.items()))]
+        with self.lock:
+            for name, stats in sorted(self.commands.items()):
+                parts.append('{} {}x avg {:.1f}s{}'.format(name, stats['count'], stats['seconds'] / stats['count'],
+                                                           ' {} timeouts'.format(stats['timeouts'])
+                                                           if stats['timeouts'] else ''))
+        parts.append('logs {:.0f} KB read'.format(self.last_log_bytes / 1e3))
+        return ' | '.join(parts)
+
+
+class Backoff(object):
+    """Polling interval that doubles each time nothing changed, up to a maximum"""
+    def __init__(self, min_interval, max_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+
+    def update(self, changed):
+        self.interval = self.min_interval if changed else min(self.interval * 2, self.max_interval)
+
+    def reset(self):
+        self.interval = self.min_interval
+
+
+class BucketSpool(object):
+    """Crash-safe ingestion of the bucket folder, whose files hold `template;args;name[;priority]` lines"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.claimed_folder = folder + '/.claimed'  # Files renamed in with the host:pid of their process as prefix
+        self.host = socket.gethostname().split('.')[0]
+        self.backlog = 0  # Lines left to submit after the last call
+
+    @property
+    def owner(self):
+        return '{}:{}'.format(self.host, getpid())
+
+    def claim(self):
+        makedirs(self.claimed_folder, exist_ok=True)
+        now = time.time()
+        for path in glob(self.folder + '/*'):
+            try:
+                st = stat(path)
+                if not Path(path).is_file() or now - st.st_mtime < BUCKET_SETTLE_TIME:  # Maybe still written to
+                    continue
+                rename(path, '{}/{}.{}'.format(self.claimed_folder, self.owner, Path(path).name))
+            except FileNotFoundError:  # Claimed by another process
+                continue
+
+        # Take over the claims of dead processes
+        for path in glob(self.claimed_folder + '/*'):
+            owner, _, name = Path(path).name.partition('.')
+            host, _, pid = owner.rpartition(':')
+            if owner == self.owner or not pid.isdigit() or not self.is_stale(path, host, pid):
+                continue
+            try:
+                rename(path, '{}/{}.{}'.format(self.claimed_folder, self.owner, name))
+            except FileNotFoundError:  # Taken over by another process
+                continue
+
+    def is_stale(self, path, host, pid):
+        if host == self.host:
+            try:
+                kill(int(pid), 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                return False
+            return False
+        # Processes of other hosts cannot be probed: wait until the claim has made no progress for a while. The
+        # mtime of a claimed file is touched on progress.
+        try:
+            return time.time() - stat(path).st_mtime > BUCKET_STALE_CLAIM
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def file_key(path):
+        """Identifies a claimed file in the task database, across takeovers"""
+        st = stat(path)
+        return '{}:{}:{}'.format(Path(path).name.partition('.')[2], st.st_ino, st.st_size)
+
+    def process(self, limit):
+        """Submit up to `limit` lines of the claimed files"""
+        self.claim()
+        self.backlog = 0
+        db = Taskman.get_db()
+        for path in sorted(glob('{}/{}.*'.format(self.claimed_folder, _glob_escape(self.owner)))):
+            with open(path, 'r') as f:
+                lines = f.read().split('\n')
+            key = self.file_key(path)
+            done = db.get_bucket_lines(key)
+
+            todo = []
+            seen = set()
+            for i, line in enumerate(lines):
+                line = line.strip()
+                if line == '' or line in seen:
+                    continue
+                seen.add(line)
+                if i not in done:
+                    todo.append((i, line))
+            batch = todo[:limit]
+            limit -= len(batch)
+            if batch:
+                new_done = self.submit(key, batch)
+                utime(path)
+                todo = [(i, line) for i, line in todo if i not in new_done]
+            if todo:
+                self.backlog += len(todo)
+            else:
+                unlink(path)
+                db.remove_bucket_lines(key)  # After the file: a crash in between must not submit its lines again
+
+    def submit(self, key, batch):
+        """Submit (line number, line) pairs of the claimed file `key`. Returns the numbers of the lines that are
+        done."""
+        by_template = {}
+        rejected = []
+        for i, line in batch:
+            tokens = line.split(';')
+            if len(tokens) not in [3, 4] or len(tokens) == 4 and not re.fullmatch(r'-?\d+', tokens[3]):
+                rejected.append((i, line, 'expected template;args;name[;priority]'))
+            else:
+                priority = int(tokens[3]) if len(tokens) == 4 else 0
+                by_template.setdefault((tokens[0], priority), []).append((i, tokens[:3]))
+
+        queued = []
+        for (template_file, priority), entries in by_template.items():
+            try:
+                jobs = Taskman.create_tasks([tokens for _, tokens in entries])
+            except OSError as e:  # Missing template
+                rejected += [(i, ';'.join(tokens), str(e)) for i, tokens in entries]
+                continue
+            # Marks the lines done in the transaction that queues them: after a crash, only the others are submitted
+            Taskman.enqueue(jobs, priority, [(key, i) for i, _ in entries])
+            queued += [i for i, _ in entries]
+
+        if rejected:
+            with open(self.folder + '/.rejected', 'a') as f:
+                for i, line, reason in rejected:
+                    f.write('{}  # {}\n'.format(line, reason))
+            Taskman.get_db().add_bucket_lines([(key, i) for i, _, _ in rejected])
+            print('{} bucket lines rejected, see {}'.format(len(rejected), self.folder + '/.rejected'))
+        return {i for i, _, _ in rejected} | set(queued)
+
+
+class QueueCache(object):
+    """Queue snapshot on disk, shared by the taskman processes of a user"""
+    def __init__(self, path):
+        self.path = path
+        self.lock_fd = None
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def covers(snapshot, ids, max_age=None, min_time=0):
+        if snapshot is None or snapshot['time'] < min_time or \
+                max_age is not None and time.time() - snapshot['time'] >= max_age:
+            return False
+        return snapshot['ids'] is None or ids is not None and set(ids) <= set(snapshot['ids'])
+
+    def write(self, statuses, ids):
+        snapshot = {'time': time.time(), 'ids': ids, 'statuses': statuses}  # ids is None for the whole user queue
+        tmp_file = '{}.{}'.format(self.path, getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+        replace(tmp_file, self.path)  # Readers never see a partial file
+        return snapshot
+
+    def acquire(self):
+        """Held while querying the scheduler: the other processes wait for the query and read its result"""
+        self.lock_fd = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        self.lock_fd.close()
+        self.lock_fd = None
+
+    def fetch(self, ids, query, min_time=0):
+        """Return a snapshot younger than the TTL and taken after `min_time`, calling `query` to take a new one if
+        needed. When the query fails, an older snapshot is returned, or None if there is none."""
+        snapshot = self.read()
+        if self.covers(snapshot, ids, QUEUE_CACHE_TTL, min_time):
+            return snapshot
+        self.acquire()
+        try:
+            snapshot = self.read()  # Maybe taken by another process while we were waiting for the lock
+            if self.covers(snapshot, ids, QUEUE_CACHE_TTL, min_time):
+                return snapshot
+            statuses = query()
+            if statuses is not None:
+                return self.write(statuses, ids)
+        finally:
+            self.release()
+        return snapshot if self.covers(snapshot, ids) else None
+
+
+class ChangeWatcher(object):
+    """Tells which refresh stages are affected by changes on disk: 'bucket', 'jobs' (dead/finished files and the
+    task database) and 'logs'"""
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, db):
+        self.db = db
+        self.data_version = db.data_version()
+        job_files = [DB_DEAD_TASKS, DB_FINISHED_TASKS]
+        # Directory -> (stage, names in the directory to watch, or None for all)
+        self.dirs = {HOMEDIR + '/taskman': ('jobs', {Path(f).name for f in job_files}),
+                     HOMEDIR + '/logs': ('logs', None)}
+        if BUCKET_FOLDER is not None:
+            self.dirs[BUCKET_FOLDER] = ('bucket', None)
+        # Polled paths, even with inotify, which does not see the writes of other machines on NFS. The mtime of a
+        # directory only changes when files are added or removed. The taskman directory is not polled: the queue
+        # snapshot and the task database are replaced or added to there.
+        self.polled = {f: 'jobs' for f in job_files}
+        self.polled.update({d: stage for d, (stage, names) in self.dirs.items() if names is None})
+        self.mtimes = {path: self.get_mtime(path) for path in self.polled}
+        self.last_poll = time.time()
+        self.min_intervals = {'logs': LOGS_MIN_INTERVAL}
+        self.last_fired = {}
+        self.pending = set()
+
+        self.fd = None
+        self.watches = {}
+        if WATCH_MODE != 'poll':
+            self.init_inotify()
+
+    def init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(O_NONBLOCK | O_CLOEXEC)
+        except (OSError, AttributeError):
+            return  # Not Linux
+        if fd < 0:
+            return
+        self.fd = fd
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for path in self.dirs:
+            wd = libc.inotify_add_watch(fd, path.encode(), mask)
+            if wd >= 0:
+                self.watches[wd] = path
+
+    @staticmethod
+    def get_mtime(path):
+        try:
+            st = stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def read_events(self):
+        try:
+            buf = read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(buf):
+            wd, _, _, name_len = self.event_header.unpack_from(buf, pos)
+            name = buf[pos + self.event_header.size:pos + self.event_header.size + name_len].rstrip(b'\0')
+            pos += self.event_header.size + name_len
+            if wd not in self.watches:
+                continue
+            stage, names = self.dirs[self.watches[wd]]
+            name = name.decode('UTF-8', 'replace')
+            # Hidden files are taskman's own (.claimed, .rejected), not changes
+            if names is None and not name.startswith('.') or names is not None and name in names:
+                self.pending.add(stage)
+
+    def poll(self):
+        self.last_poll = time.time()
+        for path, stage in self.polled.items():
+            mtime = self.get_mtime(path)
+            if mtime != self.mtimes[path]:
+                self.mtimes[path] = mtime
+                self.pending.add(stage)
+
+    def changes(self):
+        """Stages affected by the changes seen so far. Stages fired recently are held back."""
+        if self.fd is not None:
+            self.read_events()
+        data_version = self.db.data_version()
+        if data_version != self.data_version:  # Another taskman process wrote to the task database
+            self.data_version = data_version
+            self.pending.add('jobs')
+        if time.time() - self.last_poll >= WATCH_POLL_INTERVAL:
+            self.poll()
+        now = time.time()
+        ready = {s for s in self.pending if now - self.last_fired.get(s, 0) >= self.min_intervals.get(s, 0)}
+        self.pending -= ready
+        for stage in ready:
+            self.last_fired[stage] = now
+        return ready
+
+    def wait(self, timeout):
+        """Block until some stages are affected by changes, or until the timeout"""
+        deadline = time.time() + timeout
+        while True:
+            ready = self.changes()
+            remaining = deadline - time.time()
+            if ready or remaining <= 0:
+                return ready
+            wait_time = min(remaining, WATCH_POLL_INTERVAL)
+            if self.fd is not None:
+                select.select([self.fd], [], [], wait_time)
+                time.sleep(0.2)  # Let a burst of writes finish
+            else:
+                time.sleep(wait_time)
+
+
+class Screen(object):
+    """Dashboard drawn in place: only the rows that differ from the previous draw are written to the terminal.
+    Also holds the view settings: filter, sort column, order and page."""
+    def __init__(self):
+        self.rows = None  # What is on the terminal, None if unknown
+        self.size = None
+        self.query = None  # Only the jobs matching this query are shown, see JobIndex
+        self.sort_column = 'name'
+        self.reverse = False
+        self.page = 0
+
+    def invalidate(self):
+        """Something else was printed: repaint everything on the next draw"""
+        self.rows = None
+
+    def draw(self, rows):
+        size = shutil.get_terminal_size()
+        out = ['\033[?7l']  # Clip long rows instead of wrapping them onto the next row
+        old_rows = self.rows
+        if old_rows is None or size != self.size:
+            out.append('\033[2J')
+            old_rows = []
+        for i, row in enumerate(rows):
+            if i >= len(old_rows) or old_rows[i] != row:
+                out.append('\033[{};1H{}\033[K'.format(i + 1, row))
+        out.append('\033[{};1H\033[J\033[?7h'.format(len(rows) + 1))  # Clear below, leave the cursor there
+        sys.stdout.write(''.join(out))
+        sys.stdout.flush()
+        self.rows = rows
+        self.size = size
+
+    def sort_key(self):
+        """Key of the dashboard order, used with reverse=self.reverse"""
+        return JobIndex.sort_key(self.sort_column, self.reverse)
+
+    @staticmethod
+    def column_key(job, column):
+        if column == 'name':
+            return job.name, job.task_id
+        elif column == 'status':
+            return str(job.status), job.name
+        elif column in ['id', 'task_id']:
+            return job.task_id
+        elif column == 'updated':
+            value = -job.report['time'] if 'time' in job.report else None  # Most recent first
+        else:
+            value = job.report.get(column)
+        # Numbers first, then other values, then jobs without that column
+        if isinstance(value, (int, float)):
+            return 0, value, ''
+        return (1, 0, str(value)) if value is not None else (2, 0, '')
+
+
+class JobIndex(object):
+    """Task ids by name, for the queries of the commands and of the dashboard filter, e.g.
+    `sweep*_lr? status=Finished val_acc>0.9 sort:-val_acc limit:10` or `re:^sweep(1|2)_ status=Dead,Lost`."""
+    FILTER_RE = re.compile(r'([\w.]+?)(!=|<=|>=|=|<|>)(.*)')  # = and != take several values, separated by commas
+    # Filterable besides the report columns. updated is the seconds since the last report
+    FIELDS = {'status', 'id', 'task_id', 'moab_id', 'updated'}
+    OPERATORS = {'=': lambda a, b: a == b, '!=': lambda a, b: a != b, '<': lambda a, b: a < b,
+                 '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+
+    def __init__(self):
+        self.ids = {}  # Name -> task ids, in the order they were added
+        self.names = None  # Sorted names, None when a name was added since
+
+    def add(self, job):
+        ids = self.ids.get(job.name)
+        if ids is None:
+            ids = self.ids[job.name] = []
+            self.names = None
+        ids.append(job.task_id)
+
+    def match_names(self, pattern):
+        if pattern.startswith('re:'):
+            regex = re.compile(pattern[3:])
+            return [name for name in self.ids if regex.search(name)]
+        prefix = re.match(r'[^*?\[]*', pattern).group()  # Only the names with this prefix can match
+        if prefix == pattern:
+            return [pattern] if pattern in self.ids else []
+        if self.names is None:
+            self.names = sorted(self.ids)
+        names = []
+        for i in range(bisect.bisect_left(self.names, prefix), len(self.names)):
+            name = self.names[i]
+            if not name.startswith(prefix):
+                break
+            if fnmatch.fnmatchcase(name, pattern):
+                names.append(name)
+        return names
+
+    @staticmethod
+    def parse(query, columns=()):
+        """Name pattern (None if there is none), filters (jobs -> matching jobs), sort column, descending and limit
+        of a query. `columns` are the report columns that a first token can filter on."""
+        pattern, filters, sort_column, descending, limit = None, [], None, False, None
+        for i, token in enumerate(query.split()):
+            if token.startswith('sort:'):
+                sort_column = token[5:].lstrip('-')
+                descending = token[5:].startswith('-')
+            elif token.startswith('limit:'):
+                limit = int(token[6:])
+            elif i == 0 and not JobIndex.is_filter(token, columns):  # A name, unless it compares a known column
+                pattern = token
+            else:
+                m = JobIndex.FILTER_RE.fullmatch(token)
+                if m is None:
+                    raise ValueError('Bad filter {!r}, expected <column><operator><value>'.format(token))
+                filters.append(JobIndex.compile_filter(*m.groups()))
+        return pattern, filters, sort_column, descending, limit
+
+    @staticmethod
+    def is_filter(token, columns):
+        m = JobIndex.FILTER_RE.fullmatch(token)
+        return m is not None and (m.group(1) in JobIndex.FIELDS or m.group(1) in columns)
+
+    @staticmethod
+    def compile_filter(name, op, value):
+        """Function keeping the jobs of a list that pass the filter. Numbers compare as numbers, other values as
+        strings. A job without the column only passes !=."""
+        texts = value.split(',') if op in ['=', '!='] else [value]
+        numbers = []
+        for text in texts:
+            try:
+                numbers.append(float(text))
+            except ValueError:
+                pass
+        if name == 'status' and op in ['=', '!=']:
+            statuses = {status for status in JobStatus if str(status) in texts}
+            if op == '!=':
+                statuses = set(JobStatus) - statuses
+            return lambda jobs: [job for job in jobs if job.status in statuses]
+
+        if name == 'status':
+            get = lambda job: str(job.status)
+        elif name in ['id', 'task_id']:
+            get = lambda job: job.task_id
+        elif name == 'moab_id':
+            get = lambda job: job.moab_id
+        elif name == 'updated':
+            now = time.time()
+            get = lambda job: now - job.report['time'] if 'time' in job.report else None
+        else:
+            get = lambda job: job.report.get(name)
+        if op in ['=', '!=']:
+            texts, numbers = set(texts), set(numbers)
+        compare = JobIndex.OPERATORS[op]
+
+        def test(job):
+            value = get(job)
+            if value is None:
+                return op == '!='
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            if isinstance(value, (int, float)):
+                candidates = numbers
+            else:
+                value = str(value)
+                candidates = texts
+            if op == '=':
+                return value in candidates
+            elif op == '!=':
+                return value not in candidates
+            return bool(candidates) and compare(value, candidates[0])
+        return lambda jobs: [job for job in jobs if test(job)]
+
+    @staticmethod
+    def sort_key(column, descending):
+        """Jobs without the column go last in both orders"""
+        if not descending or column in ['name', 'status', 'id', 'task_id']:
+            return lambda job: Screen.column_key(job, column)
+
+        def key(job):
+            rank, value, text = Screen.column_key(job, column)
+            return -rank, value, text
+        return key
+
+    def select(self, jobs, query, columns=(), require_name=False):
+        """Jobs of `jobs` (task id -> job) matching the query. Unless it is sorted, they are grouped by name in name
+        order, or in the order of `jobs` for the '*' pattern. With require_name, a query without a name pattern is
+        an error rather than a selection of all tasks."""
+        pattern, filters, sort_column, descending, limit = self.parse(query or '', columns)
+        if pattern is None:
+            if require_name:
+                raise ValueError('No task name in {!r}, use * to select all tasks'.format(query))
+            pattern = '*'
+        if pattern == '*':
+            selected = list(jobs.values())
+        else:
+            selected = [jobs[task_id] for name in self.match_names(pattern) for task_id in self.ids[name]
+                        if task_id in jobs]
+        for keep in filters:
+            selected = keep(selected)
+        if sort_column is not None:
+            key = self.sort_key(sort_column, descending)
+            if limit is not None:
+                return (heapq.nlargest if descending else heapq.nsmallest)(limit, selected, key=key)
+            selected.sort(key=key, reverse=descending)
+        return selected[:limit] if limit is not None else selected
+
+
+class CompiledTemplate(object):
+    """Script template split once into literal text and $TASKMAN_* variables"""
+    variables = re.compile(r'\$TASKMAN_(NAME|ID|ARGS)')
+
+    def __init__(self, text, stamp):
+        self.stamp = stamp
+        self.parts = self.variables.split(text)  # Literal text at even indices, variable names at odd indices
+
+    def render(self, job):
+        values = {'NAME': job.name, 'ID': job.task_id, 'ARGS': job.args_str}
+        parts = list(self.parts)
+        parts[1::2] = [values[name] for name in parts[1::2]]
+        return ''.join(parts)
+
+
+class CheckpointStore(object):
+    """Checkpoint files addressed by their SHA-256, placed into job dirs as reflinks where possible"""
+    FICLONE = 0x40049409  # Linux ioctl sharing the extents of a file (btrfs, XFS)
+    manifest_name = '.taskman_checkpoints.json'  # Files placed into a job dir, which lets `copy` place them again
+
+    def __init__(self, folder, links=False):
+        self.folder = folder
+        self.links = links
+
+    def read_json(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def write_json(self, path, data):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f, indent=1)
+        replace(path + '.tmp', path)
+
+    def add(self, path, name):
+        """Move a checkpoint file or directory into the store. Returns its manifest {relative path: hash}.
+        If `path` does not exist anymore, the manifest stored under `name` is returned."""
+        makedirs(self.folder, exist_ok=True)
+        names = self.read_json(self.folder + '/names.json')
+        source = Path(path)
+        if not source.exists() and names.get(name) and \
+                all(Path(self.folder + '/' + digest).exists() for digest in names[name].values()):
+            return names[name]
+        files = [source] if source.is_file() else sorted(p for p in source.rglob('*') if p.is_file())
+        if not files:
+            raise FileNotFoundError(errno.ENOENT, 'No checkpoint files in ' + path, path)
+        manifest = {}
+        for file in files:
+            digest = self.add_file(str(file))
+            manifest[source.name if file == source else source.name + '/' + str(file.relative_to(source))] = digest
+        if source.is_dir():
+            shutil.rmtree(str(source))
+        names[name] = manifest  # The same checkpoint can be used again once its original has been moved in
+        self.write_json(self.folder + '/names.json', names)
+        return manifest
+
+    def add_file(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        stored = self.folder + '/' + digest
+        if Path(stored).exists():
+            unlink(path)  # Same content already stored
+            return digest
+        try:
+            rename(path, stored)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(path, stored + '.tmp')  # Other filesystem
+            rename(stored + '.tmp', stored)
+            unlink(path)
+        chmod(stored, 0o444)
+        return digest
+
+    def place(self, manifest, job_dir, move=False, source_dir=None):
+        """Put the files of a manifest into a job dir and record the manifest there. Returns how each file was
+        placed: 'reflink', 'hardlink', 'symlink', 'move' or 'copy'. With `move`, files are moved out of the store
+        rather than copied. Files no longer in the store are taken from `source_dir`."""
+        methods = []
+        for rel_path, digest in manifest.items():
+            stored = self.folder + '/' + digest
+            if source_dir is not None and not Path(stored).exists():  # Moved into a job dir
+                stored = source_dir + '/' + rel_path
+            dest = job_dir + '/' + rel_path
+            makedirs(str(Path(dest).parent), exist_ok=True)
+            methods.append(self.place_file(stored, dest, move))
+        self.write_json(job_dir + '/' + self.manifest_name, manifest)
+        return methods
+
+    def place_file(self, stored, dest, move=False):
+        try:
+            with open(stored, 'rb') as src, open(dest, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            Path(dest).unlink(missing_ok=True)
+        if self.links:
+            try:
+                link(stored, dest)
+                return 'hardlink'
+            except OSError:
+                pass
+            try:
+                symlink(stored, dest)
+                return 'symlink'
+            except OSError:
+                pass
+        elif move:
+            shutil.move(stored, dest)
+            chmod(dest, 0o644)
+            return 'move'
+        shutil.copyfile(stored, dest)
+        return 'copy'
+
+    def copy_manifest(self, source_dir, job_dir):
+        """Place the checkpoint files of another job into a job dir. Returns how each file was placed."""
+        manifest = self.read_json(source_dir + '/' + self.manifest_name)
+        if not manifest:
+            return []
+        makedirs(job_dir, exist_ok=True)
+        return self.place(manifest, job_dir, source_dir=source_dir)
+
+
+class LogCursor(object):
+    """How far the report scanner has read into a log file"""
+    def __init__(self, inode):
+        self.inode = inode
+        self.size = 0
+        self.offset = 0  # Always at the start of a line
+        self.report = None
+
+
+class FollowedLog(object):
+    """A log read as it grows, like tail -F: by name, so that a log replaced or truncated is read again from its
+    start, and a log that does not exist yet is read once it appears"""
+    def __init__(self, path, label):
+        self.path = path
+        self.label = label
+        self.inode = None
+        self.offset = 0
+        self.carry = b''  # Line still being written
+
+    def start(self, n_lines):
+        """Last n_lines lines of the log. Following starts after them."""
+        try:
+            with open(self.path, 'rb') as f:
+                self.inode = fstat(f.fileno()).st_ino
+                self.offset = f.seek(0, 2)
+                lines = Taskman.read_tail(f, self.offset, n_lines + 1)
+                f.seek(max(0, self.offset - 1))
+                if f.read(1) not in [b'\n', b'']:
+                    self.carry = lines.pop()  # Printed once complete
+        except FileNotFoundError:
+            return []
+        return [line.decode('UTF-8', 'replace') for line in lines[-n_lines:]] if n_lines else []
+
+    def poll(self):
+        """Lines completed since the last call, after a notice if the log was replaced or truncated"""
+        try:
+            st = stat(self.path)
+        except FileNotFoundError:
+            return []
+        notices = []
+        if self.inode is not None and st.st_ino != self.inode:
+            notices.append('\033[33m(log replaced, following the new file)\033[0m')
+            self.offset, self.carry = 0, b''
+        elif st.st_size < self.offset:
+            notices.append('\033[33m(log truncated)\033[0m')
+            self.offset, self.carry = 0, b''
+        self.inode = st.st_ino
+        if st.st_size == self.offset:
+            return notices
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+        Taskman.metrics.log_bytes += len(data)
+        lines = (self.carry + data).split(b'\n')
+        self.carry = lines.pop()
+        return notices + [line.decode('UTF-8', 'replace') for line in lines]
+
+
+class SeriesStore(object):
+    """Every report line of every task, as one file of doubles per report key and task (NaN where a line lacks it)"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def read_index(self, task_id):
+        try:
+            with open(self.folder + '/' + task_id + '/index.json', 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'logs': {}, 'rows': 0, 'columns': ['time']}
+
+    def column_file(self, task_id, i):
+        return '{}/{}/c{}.f64'.format(self.folder, task_id, i)
+
+    def ingest(self, task_id, log_file):
+        """Append the report lines written to log_file since the last call. Returns the number of new rows."""
+        try:
+            st = stat(log_file)
+        except FileNotFoundError:
+            return 0
+        makedirs(self.folder + '/' + task_id, exist_ok=True)
+        with open(self.folder + '/' + task_id + '/.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # Several taskman processes may scan the same logs
+            index = self.read_index(task_id)
+            read = index['logs'].get(log_file)  # A resubmitted task has one log per run
+            if read is None or read['inode'] != st.st_ino or st.st_size < read['offset']:
+                read = index['logs'][log_file] = {'inode': st.st_ino, 'offset': 0}  # New, replaced or truncated
+            if st.st_size == read['offset']:
+                return 0
+            lines, read['offset'] = self.read_reports(log_file, read['offset'], st.st_size)
+            rows = []
+            for line in lines:
+                try:
+                    report = json.loads(line[len(REPORT_PREFIX):].decode('UTF-8'))
+                except ValueError:
+                    continue
+                if isinstance(report, dict):
+                    rows.append({k: float(v) for k, v in report.items()
+                                 if isinstance(v, (int, float)) and not isinstance(v, bool)})
+            self.append(task_id, index, rows)
+            # Last, with the number of valid rows: an interrupted append is overwritten by the next one
+            tmp_file = self.folder + '/' + task_id + '/index.json.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(index, f)
+            replace(tmp_file, self.folder + '/' + task_id + '/index.json')
+            return len(rows)
+
+    @staticmethod
+    def read_reports(log_file, begin, end):
+        """Report lines of f[begin:end], and the offset just past the last complete line. `begin` must be at the
+        start of a line."""
+        lines = []
+        pattern = b'\n' + REPORT_PREFIX
+        carry = b''  # Incomplete last line of the previous block
+        with open(log_file, 'rb') as f:
+            f.seek(begin)
+            pos = begin
+            while pos < end:
+                block = f.read(min(SERIES_READ_SIZE, end - pos))
+                if not block:
+                    break
+                pos += len(block)
+                Taskman.metrics.log_bytes += len(block)
+                data = b'\n' + carry + block  # So that every line starts after a newline
+                complete = data.rfind(b'\n') + 1
+                i = data.find(pattern, 0, complete)
+                while i >= 0:
+                    j = data.index(b'\n', i + 1)
+                    lines.append(data[i + 1:j])
+                    i = data.find(pattern, j, complete)
+                carry = data[complete:]
+        return lines, pos - len(carry)
+
+    def append(self, task_id, index, rows):
+        if not rows:
+            return
+        now = time.time()
+        for row in rows:
+            row.setdefault('time', now)
+            for key in row:
+                if key not in index['columns']:
+                    index['columns'].append(key)
+        n_rows = index['rows']
+        for i, key in enumerate(index['columns']):
+            with open(self.column_file(task_id, i), 'ab') as f:
+                missing = n_rows - f.seek(0, 2) // 8
+                if missing < 0:
+                    f.truncate(n_rows * 8)  # Drop the rows of an interrupted append
+                elif missing > 0:  # New column: the earlier rows do not have the key
+                    (array('d', [math.nan]) * missing).tofile(f)
+                array('d', [row.get(key, math.nan) for row in rows]).tofile(f)
+        index['rows'] = n_rows + len(rows)
+
+    def load(self, task_id):
+        """Columns of a task as {key: memoryview of doubles}, mapped from their files"""
+        index = self.read_index(task_id)
+        columns = {}
+        if index['rows'] == 0:
+            return columns
+        for i, key in enumerate(index['columns']):
+            with open(self.column_file(task_id, i), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            columns[key] = memoryview(mapped)[:index['rows'] * 8].cast('d')
+        return columns
+
+    def remove(self, task_ids):
+        for task_id in task_ids:
+            shutil.rmtree(self.folder + '/' + task_id, ignore_errors=True)
+
+
+class Scheduler(object):
+    """Commands of a batch scheduler and the parsing of their outputs. Every command goes through run()."""
+    submit_command = None
+    supports_arrays = False
+    in_process = False  # run() answers the commands itself instead of starting a subprocess
+
+    def run(self, args, timeout=20):
+        return Taskman.get_cmd_output(args, timeout)
+
+    def try_run(self, args, timeout=20):
+        """run() for the commands whose failure is handled by the caller. Returns the output and whether the
+        command failed, in which case the output is its error output. The output is None on timeout."""
+        try:
+            return self.run(args, timeout), False
+        except subprocess.CalledProcessError as e:
+            return e.output.decode('UTF-8', 'replace'), True
+
+    def queue_commands(self, ids):
+        """Commands listing the queue, to try in order, the function parsing their output and the ids they are
+        restricted to (None for the whole user queue)"""
+        raise NotImplementedError
+
+    def submit_args(self, args):
+        return [self.submit_command] + args
+
+    @staticmethod
+    def parse_submit(output):
+        return output.strip().split(' ')[-1]
+
+    def array_args(self, jobs):
+        """Arguments of the submit command running the jobs as one job array"""
+        raise NotImplementedError
+
+    def dependency_args(self, moab_id):
+        """Arguments of the submit command holding a job until the given job has succeeded"""
+        raise NotImplementedError
+
+    def cancel_commands(self, moab_ids):
+        """Commands cancelling the jobs, with the ids each of them is about"""
+        raise NotImplementedError
+
+    def accounting_commands(self, moab_ids):
+        """Commands asking for the final state of ended jobs, and the function parsing their output into
+        {id: (status, message)}"""
+        raise NotImplementedError
+
+
+class MoabScheduler(Scheduler):
+    submit_command = 'msub'
+
+    def queue_commands(self, ids):
+        # showq cannot select jobs by id
+        return [['showq', '--xml', '-w', expandvars('user=$USER'), '--blocking']], self.parse_queue, None
+
+    @staticmethod
+    def parse_queue(output):
+        """Parse `showq --xml`. The status of a job is the queue it is in: 'active', 'eligible' or 'blocked'."""
+        statuses = {}
+        for queue in ElementTree.fromstring(output).iter('queue'):
+            option = queue.get('option')
+            for job in queue.iter('job'):
+                statuses[job.get('JobID')] = option
+        return statuses
+
+    def dependency_args(self, moab_id):
+        return ['-l', 'depend=afterok:' + moab_id]
+
+    def cancel_commands(self, moab_ids):
+        return [([moab_id], ['mjobctl', '-c', moab_id]) for moab_id in moab_ids]
+
+    def accounting_commands(self, moab_ids):
+        return [['checkjob', '--xml', moab_id] for moab_id in moab_ids], self.parse_accounting
+
+    @staticmethod
+    def parse_accounting(output):
+        """Parse `checkjob --xml`"""
+        accounting = {}
+        for job in ElementTree.fromstring(output).iter('job'):
+            state = job.get('State')
+            if state == 'Completed':
+                ok = job.get('CompletionCode', '0') == '0'
+                accounting[job.get('JobID')] = (JobStatus.Finished, '') if ok else (JobStatus.Dead, 'exit code')
+            elif state == 'Removed':
+                accounting[job.get('JobID')] = (JobStatus.Finished, 'cancel')
+            elif state == 'Vacated':
+                accounting[job.get('JobID')] = (JobStatus.Dead, state)
+        return accounting
+
+
+class SlurmScheduler(Scheduler):
+    submit_command = 'sbatch'
+    supports_arrays = True
+
+    def queue_commands(self, ids):
+        args = ['squeue', '--noheader', '--array', '--format=%i|%t']
+        by_user = args + ['--user=' + expandvars('$USER')]
+        if 0 < len(ids) <= QUEUE_MAX_IDS:
+            # squeue fails when none of the ids is known anymore
+            return [args + ['--jobs=' + ','.join(ids)], by_user], self.parse_queue, ids
+        return [by_user], self.parse_queue, None
+
+    @staticmethod
+    def parse_queue(output):
+        """Parse `squeue --format=%i|%t`: job id and compact state ('R', 'PD', ...)"""
+        statuses = {}
+        for line in output.split('\n'):
+            slurm_id, sep, slurm_state = line.partition('|')
+            if sep:
+                statuses[slurm_id.strip()] = slurm_state.strip()
+        return statuses
+
+    def array_args(self, jobs):
+        """Write an array script running the i-th job script in the i-th array task"""
+        header = Taskman.get_script_header(jobs[0].script_file)
+        lines = [l.replace('%j', '%A_%a') for l in header]  # Log files are named after <array id>_<index>
+        lines.append('export TASKMAN_JOB_ID=${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}\n')
+        lines.append('case $SLURM_ARRAY_TASK_ID in\n')
+        for i, job in enumerate(jobs):
+            lines.append('{}) exec bash {} ;;\n'.format(i, job.script_file))
+        lines.append('esac\n')
+
+        script_path, _ = Job.get_path(jobs[0].name, jobs[0].task_id)
+        array_file = script_path + '/array_' + jobs[0].task_id + '.sh'
+        with open(array_file, 'w') as f:
+            f.writelines(lines)
+        return ['--array=0-{}'.format(len(jobs) - 1), array_file]
+
+    def dependency_args(self, moab_id):
+        return ['--dependency=afterok:' + moab_id]
+
+    def cancel_commands(self, moab_ids):
+        chunks = [moab_ids[i:i + CANCEL_CHUNK] for i in range(0, len(moab_ids), CANCEL_CHUNK)]
+        return [(chunk, ['scancel'] + chunk) for chunk in chunks]
+
+    def accounting_commands(self, moab_ids):
+        chunks = [moab_ids[i:i + ACCOUNTING_CHUNK] for i in range(0, len(moab_ids), ACCOUNTING_CHUNK)]
+        return [['sacct', '--noheader', '--parsable2', '--allocations', '--format=JobID,State',
+                 '--jobs=' + ','.join(chunk)] for chunk in chunks], self.parse_accounting
+
+    @staticmethod
+    def parse_accounting(output):
+        """Parse `sacct --parsable2 --format=JobID,State`"""
+        accounting = {}
+        for line in output.split('\n'):
+            tokens = line.strip().split('|')
+            if len(tokens) < 2:
+                continue
+            state = tokens[1].split(' ')[0]  # 'CANCELLED by 1234'
+            if state == 'COMPLETED':
+                accounting[tokens[0]] = (JobStatus.Finished, '')
+            elif state == 'CANCELLED':
+                accounting[tokens[0]] = (JobStatus.Finished, 'cancel')
+            elif state in ['FAILED', 'TIMEOUT', 'NODE_FAIL', 'OUT_OF_MEMORY', 'BOOT_FAIL', 'DEADLINE', 'PREEMPTED']:
+                accounting[tokens[0]] = (JobStatus.Dead, state)
+        return accounting
+
+
+class SimJob(object):
+    def __init__(self, job_id, argv, env, name):
+        self.job_id = job_id
+        self.argv = argv
+        self.env = env
+        self.name = name
+        self.state = 'PD'  # Then 'R', then a final sacct state
+        self.proc = None
+        self.after = None  # Job that must complete first
+
+
+class SimScheduler(SlurmScheduler):
+    """Local stand-in for SLURM, to load test taskman without a cluster. Jobs run as local processes."""
+    in_process = True
+    id_file = HOMEDIR + '/taskman/sim_next_id'  # Job ids stay unique across runs
+    header_option = re.compile(r'#SBATCH\s+(-o|--output|-e|--error|-J|--job-name)[=\s]\s*(\S+)')
+
+    def __init__(self):
+        self.delay = float(env_vars.get('TASKMAN_SIM_DELAY', 5))  # Mean queue delay of a job, in seconds
+        self.slots = int(env_vars.get('TASKMAN_SIM_SLOTS', 8))  # Jobs running at once
+        self.latency = float(env_vars.get('TASKMAN_SIM_LATENCY', 0.05))  # Mean duration of a command, in seconds
+        self.error_rate = float(env_vars.get('TASKMAN_SIM_ERRORS', 0))  # Probability that a command fails
+        self.failure_rate = float(env_vars.get('TASKMAN_SIM_FAILURES', 0))  # Probability that a job dies on its node
+        self.n_others = int(env_vars.get('TASKMAN_SIM_QUEUE', 0))  # Jobs of other workflows in the user queue
+        self.rng = random.Random()
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.queue = []  # Heap of (eligible time, job id) of the pending jobs
+        self.held = {}  # Pending jobs waiting for another job to complete
+        self.running = {}
+        self.others = None  # squeue lines of the other jobs
+        self.next_id = None
+        self.thread = None
+
+    def run(self, args, timeout=20):
+        start = time.time()
+        latency = self.rng.expovariate(1 / self.latency) if self.latency > 0 else 0
+        time.sleep(min(latency, timeout))
+        if latency > timeout:
+            Taskman.record_command(args, start, 'timeout')
+            return None
+        handlers = {'sbatch': self.sbatch, 'squeue': self.squeue, 'scancel': self.scancel, 'sacct': self.sacct}
+        with self.lock:
+            if self.thread is None:
+                self.start()
+            if self.rng.random() < self.error_rate:
+                output, failed = args[0] + ': error: Socket timed out on send/recv operation\n', True
+            else:
+                output, failed = handlers[args[0]](args[1:])
+        if failed:
+            Taskman.record_command(args, start, 'error', output)
+            raise subprocess.CalledProcessError(1, args, output.encode('UTF-8'))
+        Taskman.record_command(args, start, 'ok')
+        return output
+
+    def start(self):
+        try:
+            with open(self.id_file, 'r') as f:
+                self.next_id = int(f.read())
+        except (FileNotFoundError, ValueError):
+            self.next_id = 1000
+        first_other = 10 ** max(7, len(str(self.next_id)) + 1)
+        self.others = ''.join('{}|{}\n'.format(first_other + i, 'R' if self.rng.random() < 0.2 else 'PD')
+                              for i in range(self.n_others))
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def new_id(self):
+        job_id = self.next_id
+        self.next_id += 1
+        with open(self.id_file, 'w') as f:
+            f.write(str(self.next_id))
+        return str(job_id)
+
+    def loop(self):
+        while True:
+            time.sleep(0.1)
+            with self.lock:
+                self.step()
+
+    def step(self):
+        """Reap the jobs that exited and start the pending jobs that are due, as long as slots are free"""
+        for job_id, job in list(self.running.items()):
+            code = job.proc.poll()
+            if code is not None:
+                job.state = 'COMPLETED' if code == 0 else 'FAILED'
+                del self.running[job_id]
+        for job_id, job in list(self.held.items()):
+            parent = self.jobs.get(job.after)
+            if job.state != 'PD':  # Cancelled
+                del self.held[job_id]
+            elif parent is not None and parent.state == 'COMPLETED':  # Held forever otherwise, like SLURM does
+                del self.held[job_id]
+                self.enqueue(job)
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now and len(self.running) < self.slots:
+            _, job_id = heapq.heappop(self.queue)
+            job = self.jobs[job_id]
+            if job.state != 'PD':  # Cancelled
+                continue
+            if self.rng.random() < self.failure_rate:
+                job.state = 'NODE_FAIL'
+                continue
+            self.launch(job)
+
+    def launch(self, job):
+        options = {}
+        try:
+            with open(job.argv[-1], 'r') as f:
+                for line in f:
+                    if line.strip() != '' and not line.startswith('#'):
+                        break
+                    match = self.header_option.match(line)
+                    if match:
+                        option = match.group(1).lstrip('-')
+                        options[{'output': 'o', 'error': 'e', 'job-name': 'J'}.get(option, option)] = match.group(2)
+        except OSError:
+            job.state = 'FAILED'
+            return
+        array_id, _, index = job.job_id.partition('_')
+        values = {'j': job.job_id, 'A': array_id, 'a': index, 'x': options.get('J', job.name), 'u': expandvars('$USER'),
+                  '%': '%'}
+
+        def log_path(pattern):
+            path = re.sub(r'%([jAax%u])', lambda m: values[m.group(1)], pattern)
+            return path if path.startswith('/') else HOMEDIR + '/' + path
+        out_file = log_path(options.get('o', 'slurm-%j.out'))
+        err_file = log_path(options['e']) if 'e' in options else out_file
+        try:
+            with open(out_file, 'a') as out, open(err_file, 'a') as err:
+                job.proc = subprocess.Popen(job.argv, stdin=subprocess.DEVNULL, stdout=out, stderr=err, env=job.env,
+                                            cwd=HOMEDIR, start_new_session=True)
+        except OSError:
+            job.state = 'FAILED'
+            return
+        job.state = 'R'
+        self.running[job.job_id] = job
+
+    def enqueue(self, job):
+        self.jobs[job.job_id] = job
+        delay = self.rng.expovariate(1 / self.delay) if self.delay > 0 else 0
+        heapq.heappush(self.queue, (time.time() + delay, job.job_id))
+
+    def sbatch(self, args):
+        options = [a for a in args if a.startswith('--')]
+        script = [a for a in args if not a.startswith('--')][-1]
+        if not Path(script).is_file():
+            return 'sbatch: error: Unable to open file {}\n'.format(script), True
+        env = dict(env_vars, SLURM_SUBMIT_DIR=HOMEDIR)
+        name = Path(script).name
+        arrays = [o for o in options if o.startswith('--array=')]
+        job_id = self.new_id()
+        dependencies = [o for o in options if o.startswith('--dependency=afterok:')]
+        if dependencies:
+            job = SimJob(job_id, ['bash', script], dict(env, SLURM_JOB_ID=job_id), name)
+            job.after = dependencies[0][len('--dependency=afterok:'):]
+            self.jobs[job_id] = job
+            self.held[job_id] = job
+        elif not arrays:
+            self.enqueue(SimJob(job_id, ['bash', script], dict(env, SLURM_JOB_ID=job_id), name))
+        else:
+            first, _, last = arrays[0][len('--array='):].partition('-')
+            for i in range(int(first), int(last or first) + 1):
+                task_env = dict(env, SLURM_JOB_ID=self.new_id(), SLURM_ARRAY_JOB_ID=job_id, SLURM_ARRAY_TASK_ID=str(i))
+                self.enqueue(SimJob('{}_{}'.format(job_id, i), ['bash', script], task_env, name))
+        return 'Submitted batch job {}\n'.format(job_id), False
+
+    def squeue(self, args):
+        ids = None
+        for arg in args:
+            if arg.startswith('--jobs='):
+                ids = arg[len('--jobs='):].split(',')
+        if ids is None:
+            return ''.join('{}|{}\n'.format(j.job_id, j.state) for j in self.jobs.values()
+                           if j.state in ['PD', 'R']) + self.others, False
+        if not any(i in self.jobs for i in ids):
+            return 'slurm_load_jobs error: Invalid job id specified\n', True
+        return ''.join('{}|{}\n'.format(i, self.jobs[i].state) for i in ids
+                       if i in self.jobs and self.jobs[i].state in ['PD', 'R']), False
+
+    def scancel(self, args):
+        output = ''
+        for job_id in args:
+            job = self.jobs.get(job_id)
+            if job is None:
+                output += 'scancel: error: Kill job error on job id {}: Invalid job id specified\n'.format(job_id)
+            elif job.state not in ['PD', 'R']:
+                output += 'scancel: error: Kill job error on job id {}: Job/step already completing or completed\n'\
+                    .format(job_id)
+            else:
+                if job.state == 'R':
+                    try:
+                        killpg(job.proc.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                    del self.running[job_id]
+                job.state = 'CANCELLED'
+        return output, output != ''
+
+    def sacct(self, args):
+        ids = []
+        for arg in args:
+            if arg.startswith('--jobs='):
+                ids = arg[len('--jobs='):].split(',')
+        states = {'PD': 'PENDING', 'R': 'RUNNING'}
+        return ''.join('{}|{}\n'.format(i, states.get(self.jobs[i].state, self.jobs[i].state)) for i in ids
+                       if i in self.jobs), False
+
+
+SCHEDULERS = {'moab': MoabScheduler, 'slurm': SlurmScheduler, 'sim': SimScheduler}
+
+
 class Taskman(object):
     jobs = {}
+    active_jobs = {}  # Jobs that are not frozen
+    index = JobIndex()
     columns = set()
+    frozen_columns = set()
     jobid_nchars = 7
+    log_cursors = {}
+    series = SeriesStore(SERIES_FOLDER) if SERIES_FOLDER is not None else None
+    ckpt_store = CheckpointStore(CKPT_STORE_FOLDER, CKPT_LINKS)
+    bucket = BucketSpool(BUCKET_FOLDER) if BUCKET_FOLDER is not None else None
+    db = None
+    db_rev = 0
+    db_generation = None
+    last_task_id = None
+    templates = {}
+    screen = Screen()
+    metrics = Metrics(METRICS_FILE)
+    statuses = None
+    queue_time = None
+    queue_cache = QueueCache(QUEUE_CACHE_FILE)
+    scheduler = SCHEDULERS[SCHEDULER]()
+    accounting = {}
+    accounting_misses = {}
+    queue_backoff = Backoff(QUEUE_MIN_INTERVAL, QUEUE_MAX_INTERVAL)
+    next_queue_poll = 0
+    queue_min_time = 0  # Snapshots taken before the last submission or cancellation are outdated
+    recent_submissions = {}  # moab_id: time of the submissions the queue snapshot may not show yet
+
+    @staticmethod
+    def get_db():
+        if Taskman.db is None:
+            Taskman.db = TaskDB(DB_FILE)
+        return Taskman.db
+
+    @staticmethod
+    def record_command(args, start, outcome, output=None):
+        """Record the latency and outcome ('ok', 'error' or 'timeout') of a scheduler command started at `start`,
+        and print the failed ones with their output"""
+        Taskman.metrics.record_command(args, time.time() - start, outcome)
+        if outcome != 'ok':
+            print('{} with command: {}'.format(outcome.capitalize(), ' '.join(args)))
+            if output is not None:
+                print(output)
 
     @staticmethod
     def get_cmd_output(args, timeout=20):
+        start = time.time()
         try:
             output = subprocess.check_output(args, stderr=subprocess.STDOUT, timeout=timeout)
         except subprocess.CalledProcessError as e:
-            print('Error with command: ' + ' '.join(args))
-            print(e.output)
+            Taskman.record_command(args, start, 'error', e.output)
             raise
         except subprocess.TimeoutExpired as e:
-            print('Timeout with command: ' + ' '.join(args))
-            print(e.output)
+            Taskman.record_command(args, start, 'timeout', e.output)
             return None
+        Taskman.record_command(args, start, 'ok')
         return output.decode('UTF-8')
 
     @staticmethod
     def get_queue():
-        if SLURM_MODE:
-            return Taskman.get_slurm_queue()
-        else:
-            return Taskman.get_moab_queue()
+        commands, parse, ids = Taskman.scheduler.queue_commands(Taskman.queue_ids())
+        snapshot = Taskman.queue_cache.fetch(ids, lambda: Taskman.run_queue_commands(commands, parse),
+                                             Taskman.queue_min_time)
+        return Taskman.use_snapshot(snapshot)
 
     @staticmethod
-    def get_moab_queue():
-        args = ['showq', '-w', expandvars('user=$USER'), '--blocking']
-        output = Taskman.get_cmd_output(args, timeout=10)
-        if output is None:
-            return None
+    def use_snapshot(snapshot):
+        Taskman.queue_time = None if snapshot is None else snapshot['time']
+        if snapshot is not None:
+            Taskman.recent_submissions = {moab_id: t for moab_id, t in Taskman.recent_submissions.items()
+                                          if t >= snapshot['time']}
+        return None if snapshot is None else snapshot['statuses']
 
-        showq_lines = output.split('\n')
-        showq_lines = [l.strip() for l in showq_lines]
-        lists = {'active j': [], 'eligible': [], 'blocked ': []}
-        cur_list = None
-        statuses = {}
-        for line in showq_lines:
-            if line[:8] in lists:
-                cur_list = line[:8]
-            elif line != '' and \
-                            'JOBID' not in line and \
-                            'processors' not in line and \
-                            'nodes' not in line and \
-                            'eligible' not in line and \
-                            'Total' not in line and \
-                            'blocked' not in line:
-                moab_id = line.split(' ')[0]
-                statuses[moab_id] = cur_list
-        return statuses
+    @staticmethod
+    def run_queue_commands(commands, parse):
+        """Return the parsed output of the first command that succeeds, or None on timeout"""
+        for args in commands:
+            output, failed = Taskman.scheduler.try_run(args, timeout=10)
+            if output is None:
+                return None
+            statuses = None if failed else Taskman.try_parse(parse, args, output)
+            if statuses is not None:
+                return statuses
+        return None
 
     @staticmethod
-    def get_slurm_queue():
-        args = ['squeue', '-u', expandvars('$USER')]
-        output = Taskman.get_cmd_output(args, timeout=10)
-        if output is None:
+    def try_parse(parse, args, output):
+        """parse(output), or None if the command printed something else, such as a warning or truncated XML"""
+        try:
+            return parse(output)
+        except (ElementTree.ParseError, ValueError):
+            print('Unexpected output of command: ' + ' '.join(args))
+            print(output)
             return None
 
-        showq_lines = output.split('\n')
-        showq_lines = [l for l in showq_lines]
-        statuses = {}
-        for line in showq_lines[1:]:  # skip header
-            slurm_id = line[:8].strip()
-            slurm_state = line[47:50].strip()
-            statuses[slurm_id] = slurm_state
-        return statuses
+    @staticmethod
+    def tracked_ids():
+        return [j.moab_id for j in Taskman.active_jobs.values()
+                if j.status not in [JobStatus.Dead, JobStatus.Finished, JobStatus.Pending, JobStatus.Failed]]
+
+    @staticmethod
+    def queue_ids():
+        """Job ids the queue snapshot is restricted to, none for the whole user queue. With MAX_QUEUED, every job
+        of the user counts, including the pre-queued segments and the jobs of other workflows."""
+        return [] if MAX_QUEUED > 0 else Taskman.tracked_ids()
+
+    @staticmethod
+    def get_accounting(moab_ids):
+        """Final state (status, message) of the jobs that have ended, from the scheduler accounting"""
+        commands, parse = Taskman.scheduler.accounting_commands(moab_ids)
+        accounting = {}
+        with ThreadPoolExecutor(SUBMIT_WORKERS) as pool:
+            for args, (output, failed) in zip(commands, pool.map(Taskman.scheduler.try_run, commands)):
+                if output is not None and not failed:
+                    accounting.update(Taskman.try_parse(parse, args, output) or {})
+        return accounting
+
+    @staticmethod
+    def get_template(template_file):
+        """Template with the post exec script appended, compiled once and recompiled when one of them changes"""
+        paths = [SCRIPTS_FOLDER + '/' + template_file + '.sh', SCRIPTS_FOLDER + '/taskman_post_exec.sh']
+        stamp = [(st.st_mtime_ns, st.st_size) for st in map(stat, paths)]
+        template = Taskman.templates.get(template_file)
+        if template is None or template.stamp != stamp:
+            text = ''
+            for path in paths:
+                with open(path, 'r') as f:
+                    text += f.read()
+            template = CompiledTemplate(text, stamp)
+            Taskman.templates[template_file] = template
+        return template
 
     @staticmethod
     def generate_script(job):
-        script_path, script_file = Job.get_path(job.name, job.task_id)
-
-        # Get template
-        with open(SCRIPTS_FOLDER + '/' + job.template_file + '.sh', 'r') as f:
-            template = f.readlines()
-
-        # Append post exec bash script
-        with open(SCRIPTS_FOLDER + '/taskman_post_exec.sh', 'r') as f:
-            post_exec = f.readlines()
-        template += post_exec
-
-        # Replace variables
-        script_lines = []
-        for line in template:
-            line = line.replace('$TASKMAN_NAME', job.name)
-            line = line.replace('$TASKMAN_ID', job.task_id)
-            line = line.replace('$TASKMAN_ARGS', job.args_str)
-            script_lines.append(line)
-
-        # Write script
-        makedirs(script_path, exist_ok=True)
-        with open(script_file, 'w') as f:
-            f.writelines(script_lines)
+        return Taskman.generate_scripts([job])[0]
 
-        return script_file
+    @staticmethod
+    def generate_scripts(jobs):
+        templates = {}
+        script_paths = set()
+        script_files = []
+        for job in jobs:
+            if job.template_file not in templates:
+                templates[job.template_file] = Taskman.get_template(job.template_file)
+            script_path, script_file = Job.get_path(job.name, job.task_id)
+            if script_path not in script_paths:
+                makedirs(script_path, exist_ok=True)
+                script_paths.add(script_path)
+            with open(script_file, 'w') as f:
+                f.write(templates[job.template_file].render(job))
+            script_files.append(script_file)
+        return script_files
 
     @staticmethod
     def create_task(template_file, args_str, task_name):
-        # Generate id
-        task_id = datetime.now().strftime("%m-%d_%H-%M-%S_%f")
-        job = Job(task_id, task_name, None, None, template_file, args_str)
-        script_file = Taskman.generate_script(job)
-
-        print('Created', script_file)
-        return job
+        return Taskman.create_tasks([(template_file, args_str, task_name)])[0]
 
     @staticmethod
-    def write_started(job, db_file=None):
-        if db_file is None:
-            f = open(DB_STARTED_TASKS, 'a')
-        else:
-            f = db_file
+    def create_tasks(specs):
+        """Create the tasks described by (template_file, args_str, task_name) and write their scripts"""
+        jobs = []
+        for template_file, args_str, task_name in specs:
+            # Generate id, unique even when many tasks are created at once
+            task_id = datetime.now().strftime("%m-%d_%H-%M-%S_%f")
+            while task_id == Taskman.last_task_id:
+                task_id = datetime.now().strftime("%m-%d_%H-%M-%S_%f")
+            Taskman.last_task_id = task_id
+            jobs.append(Job(task_id, task_name, None, None, template_file, args_str))
+
+        for script_file in Taskman.generate_scripts(jobs):
+            print('Created', script_file)
+        return jobs
 
-        line = '{};{};{};{};{}'.format(job.task_id, job.name, job.moab_id, job.template_file, job.args_str)
-        f.write(line + '\n')
+    @staticmethod
+    def enqueue(jobs, priority=0, bucket_lines=()):
+        """Queue jobs for submission, then submit as many of them as the cluster limits allow. The (file key, line
+        number) pairs of the bucket lines they come from are recorded as done at the same time."""
+        if not jobs:
+            return
+        Taskman.get_db().add_pending(jobs, priority, bucket_lines)
+        for job in jobs:
+            job.status = JobStatus.Pending
+        print('{} tasks queued for submission'.format(len(jobs)))
+        Taskman.admit()
 
-        if db_file is None:
-            f.close()
+    @staticmethod
+    def queue_capacity():
+        """How many more jobs may be queued: -1 without limit, None while the queue is unknown"""
+        if MAX_QUEUED <= 0:
+            return -1
+        if Taskman.statuses is None:
+            return None
+        return max(0, MAX_QUEUED - len(Taskman.statuses) - len(Taskman.recent_submissions))
 
     @staticmethod
-    def submit(job):
-        subm_command = 'sbatch' if SLURM_MODE else 'msub'
+    def admit():
+        """Submit queued tasks, by priority, while the scheduler has fewer than MAX_QUEUED of our jobs. Failed
+        submissions stay queued and are tried again later."""
+        db = Taskman.get_db()
+        capacity = Taskman.queue_capacity()
+        if capacity is None:
+            return
+        if capacity == 0:
+            if db.count_pending():
+                Taskman.queue_backoff.reset()  # Poll often, to see slots free up
+            return
 
-        print('Calling ' + subm_command + '...', end=' ')
-        output = Taskman.get_cmd_output([subm_command, job.script_file])
-        if output is None:
+        rows = db.claim_pending(time.time(), capacity)
+        if not rows:
             return
+        jobs = [Taskman.jobs.get(task_id) or Job(task_id, name, moab_id, JobStatus.Pending, template_file, args_str)
+                for task_id, name, moab_id, template_file, args_str in rows]
+        errors = {}
+        Taskman.submit_many(jobs, errors)
+        if errors:
+            for task_id in db.retry_pending(errors, time.time()):
+                job = next(j for j in jobs if j.task_id == task_id)
+                print('Gave up submitting {} after {} attempts: {}'.format(job.name, SUBMIT_ATTEMPTS, errors[task_id]))
 
-        job.prev_moab_id = job.moab_id or ''
-        job.moab_id = output.strip().split(' ')[-1]
+    @staticmethod
+    def submit_many(jobs, errors=None):
+        """Submit many jobs, as job arrays when possible, and record them in the database in one write. The error
+        of each job that could not be submitted is put in `errors`, if given."""
+        scheduler = Taskman.scheduler
+        use_arrays = JOB_ARRAYS and scheduler.supports_arrays
+        print('Submitting {} tasks...'.format(len(jobs)))
+
+        # Jobs whose scripts have the same scheduler directives can share a job array
+        groups = {}
+        for job in jobs:
+            key = (job.template_file, tuple(Taskman.get_script_header(job.script_file))) if use_arrays else job
+            groups.setdefault(key, []).append(job)
+        arrays = [g for g in groups.values() if len(g) > 1]
+        singles = [g[0] for g in groups.values() if len(g) == 1]
+
+        with ThreadPoolExecutor(SUBMIT_WORKERS) as pool:
+            array_outputs = pool.map(scheduler.try_run,
+                                     [scheduler.submit_args(scheduler.array_args(g)) for g in arrays])
+            single_outputs = pool.map(scheduler.try_run, [scheduler.submit_args([j.script_file]) for j in singles])
+            new_ids = []
+            failures = []
+            for group, (output, failed) in zip(arrays, array_outputs):
+                if output is not None and not failed:
+                    array_id = scheduler.parse_submit(output)
+                    new_ids += [(job, '{}_{}'.format(array_id, i)) for i, job in enumerate(group)]
+                else:
+                    failures += [(job, output) for job in group]
+            for job, (output, failed) in zip(singles, single_outputs):
+                if output is not None and not failed:
+                    new_ids.append((job, scheduler.parse_submit(output)))
+                else:
+                    failures.append((job, output))
+        if errors is not None:
+            errors.update({job.task_id: 'timeout' if output is None else output.strip() or 'failed'
+                           for job, output in failures})
 
-        # Add to 'started' database
-        Taskman.write_started(job)
+        for job, moab_id in new_ids:
+            job.prev_moab_id = job.moab_id or ''
+            job.moab_id = moab_id
+            print('Submitted.  TaskmanID: {}  Moab/SLURM ID: {}'.format(job.task_id, job.moab_id))
+        submitted = [job for job, _ in new_ids]
 
-        print('Submitted.  TaskmanID: {}  Moab/SLURM ID: {}'.format(job.task_id, job.moab_id))
+        # Add to 'started' database
+        if submitted:
+            Taskman.get_db().add_started(submitted)
+            Taskman.recent_submissions.update({job.moab_id: time.time() for job in submitted})
+            Taskman.queue_changed()
+        if len(submitted) < len(jobs):
+            print('{} of {} tasks could not be submitted'.format(len(jobs) - len(submitted), len(jobs)))
+        return submitted
 
     @staticmethod
-    def cancel(task_id):
-        job = Taskman.jobs[task_id]
-        cmd_tokens = ['scancel', job.moab_id] if SLURM_MODE else ['mjobctl', '-c', job.moab_id]
+    def get_script_header(script_file):
+        """Leading comment lines of a script, which hold the scheduler directives"""
+        header = []
+        with open(script_file, 'r') as f:
+            for line in f:
+                if line.strip() != '' and not line.startswith('#'):
+                    break
+                header.append(line)
+        return header
 
-        output = Taskman.get_cmd_output(cmd_tokens)
-        if output is None:
-            return
+    @staticmethod
+    def cancel_many(task_ids):
+        """Cancel jobs with as few scheduler calls as possible and print the outcome of each"""
+        jobs = [Taskman.jobs[task_id] for task_id in task_ids]
+        pending = [j for j in jobs if j.status in [JobStatus.Pending, JobStatus.Failed]]
+        if pending:  # Not submitted yet, only needs to leave the submission queue
+            Taskman.get_db().remove_pending([j.task_id for j in pending])
+            for j in pending:
+                print('{:<10} {:<30}'.format('Dequeued', short_str(j.name, 30)))
+            jobs = [j for j in jobs if j.status not in [JobStatus.Pending, JobStatus.Failed]]
+        by_id = {j.moab_id: j for j in jobs}
+        chunks, commands = [], []
+        for moab_ids, args in Taskman.scheduler.cancel_commands(list(by_id)):
+            chunks.append([by_id[moab_id] for moab_id in moab_ids])
+            commands.append(args)
+
+        results = []
+        with ThreadPoolExecutor(SUBMIT_WORKERS) as pool:
+            for chunk, (output, failed) in zip(chunks, pool.map(Taskman.scheduler.try_run, commands)):
+                if output is None:
+                    results += [(j, 'timeout') for j in chunk]
+                    continue
+                # Errors name the job ids they are about
+                errors = {}
+                for line in output.split('\n'):
+                    if 'error' in line.lower():
+                        for token in re.findall(r'[\w.\[\]-]+', line):
+                            errors.setdefault(token, line.strip())
+                named = any(j.moab_id in errors for j in chunk)
+                for j in chunk:
+                    error = errors.get(j.moab_id)
+                    if error is None and failed and not named:  # The whole call failed
+                        error = output.strip() or 'failed'
+                    results.append((j, error))
 
         # Add to 'finished' database
-        with open(HOMEDIR + '/taskman/finished', 'a') as f:
-            line = '{},{},{}'.format(job.moab_id, job.name, 'cancel')
-            f.write(line + '\n')
+        cancelled = [j for j, error in results if error is None]
+        if cancelled:
+            Taskman.get_db().add_finished([(j.moab_id, 'cancel') for j in cancelled])
+            Taskman.queue_changed()
+            chains = Taskman.get_db().get_chains()
+            chained = [j.task_id for j in cancelled if j.task_id in chains]
+            if chained:  # Their next segments too
+                Taskman.cancel_continuations([chains[task_id][1] for task_id in chained])
+                Taskman.get_db().remove_chains(chained)
+
+        for j, error in results:
+            print('{:<10} {:<30} {:<{}} {}'.format('Cancelled' if error is None else 'Failed', short_str(j.name, 30),
+                                                  j.moab_id, Taskman.jobid_nchars, error or ''))
+        print('{} of {} jobs cancelled'.format(len(cancelled), len(jobs)))
 
-        print(output.strip())
+    @staticmethod
+    def result_path(job):
+        return CKPT_FOLDER + '/' + job.name + '/' + job.task_id + '/results.csv'
 
     @staticmethod
-    def read_task_db():
-        with open(HOMEDIR + '/taskman/started', 'r') as f:
-            started_tasks_csv = f.readlines()
-        with open(HOMEDIR + '/taskman/dead', 'r') as f:
-            dead_tasks_csv = f.readlines()
-        with open(HOMEDIR + '/taskman/finished', 'r') as f:
-            finished_tasks_csv = f.readlines()
+    def read_result_table(job):
+        """Header and rows of the results.csv of a job"""
+        with open(Taskman.result_path(job), 'r', newline='') as f:
+            table = list(csv.reader(f))
+        return (table[0] if table else []), table[1:]
 
-        if len(started_tasks_csv) == 0 or len(started_tasks_csv) == 1 and started_tasks_csv[0].strip() == '':
-            started_tasks = None
-        else:
-            started_tasks = {tokens[0]: tokens[1:] for tokens in [l.strip().split(';')
-                                                                  for l in started_tasks_csv if l.strip() != '']}
-        dead_tasks = {tokens[0]: tokens[1:] for tokens in [l.strip().split(',') for l in dead_tasks_csv]}
-        finished_tasks = {tokens[0]: tokens[1:] for tokens in [l.strip().split(',') for l in finished_tasks_csv]}
-        return started_tasks, dead_tasks, finished_tasks
+    @staticmethod
+    def read_results(jobs, tables=None):
+        """Summary of the results.csv of each job: its stamp, header, number of rows and the moments of each
+        numeric column (see _column_moments). Files are read in parallel, and only if they changed since their
+        summary was cached in the database. The (header, rows) of the files read are put in `tables`, if given."""
+        db = Taskman.get_db()
+        cached = db.get_results([j.task_id for j in jobs])
+
+        def read(job):
+            try:
+                st = stat(Taskman.result_path(job))
+            except FileNotFoundError:
+                return None, None
+            stamp = '{}:{}'.format(st.st_mtime_ns, st.st_size)
+            entry = cached.get(job.task_id)
+            if entry is not None and entry[0] == stamp:
+                return None, json.loads(entry[1])
+            header, rows = Taskman.read_result_table(job)
+            if tables is not None:
+                tables[job.task_id] = header, rows
+            moments = {}
+            for i, column in enumerate(header):
+                column_moments = _column_moments(row[i] for row in rows if i < len(row))
+                if column_moments is not None:
+                    moments[column] = column_moments
+            summary = {'stamp': stamp, 'header': header, 'rows': len(rows), 'moments': moments}
+            return (job.task_id, stamp, json.dumps(summary)), summary
+
+        summaries = {}
+        new_entries = []
+        with ThreadPoolExecutor(SUBMIT_WORKERS) as pool:
+            for job, (entry, summary) in zip(jobs, pool.map(read, jobs)):
+                if summary is not None:
+                    summaries[job.task_id] = summary
+                if entry is not None:
+                    new_entries.append(entry)
+        if new_entries:
+            db.set_results(new_entries)
+        return summaries
 
     @staticmethod
     def process_bucket():
-        if BUCKET_FOLDER is None:
-            return
-
-        for f in glob(BUCKET_FOLDER + '/*'):
-            filepath = Path(f)
-            lines = filepath.read_text().strip().split('\n')
-            for l in lines:
-                submit(*l.split(';'))
-            filepath.unlink()
+        if Taskman.bucket is not None:
+            Taskman.bucket.process(BUCKET_BATCH)
 
     @staticmethod
-    def update_job_list():
-        statuses = Taskman.get_queue()
-
-        started_tasks, dead_tasks, finished_tasks = Taskman.read_task_db()
-        if started_tasks is None:
-            return
+    def set_queue(statuses):
+        """Store a new queue snapshot and schedule the next poll. Polling slows down while the queue is idle."""
+        Taskman.queue_backoff.update(statuses != Taskman.statuses)
+        Taskman.statuses = statuses
+        interval = Taskman.queue_backoff.interval
+        if any(j.status in [JobStatus.Running, JobStatus.Waiting] for j in Taskman.active_jobs.values()):
+            interval = min(interval, REFRESH_INTERVAL)  # They may start or die without any other sign
+        Taskman.next_queue_poll = time.time() + interval
 
-        jobs = {}
+    @staticmethod
+    def queue_changed():
+        """Jobs were submitted or cancelled: poll the queue again now, without the cached snapshot"""
+        Taskman.queue_backoff.reset()
+        Taskman.next_queue_poll = 0
+        Taskman.queue_min_time = time.time()
 
-        for task_id, fields in sorted(started_tasks.items(), key=lambda x: x[1][0]):
-            name, moab_id, template_file, args_str = fields
-            j = Job(task_id, name, moab_id, None, template_file, args_str)
+    @staticmethod
+    def sync_job_list(statuses):
+        """Bring Taskman.jobs up to date with the task database and the scheduler queue. Returns the ids of the
+        jobs that are new or changed status."""
+        db = Taskman.get_db()
+        db.sync_outcomes()
+        if db.generation() != Taskman.db_generation:  # Tasks were removed, reload everything
+            Taskman.jobs = {}
+            Taskman.active_jobs = {}
+            Taskman.index = JobIndex()
+            Taskman.frozen_columns = set()
+            Taskman.db_rev = 0
+            Taskman.db_generation = db.generation()
+        Taskman.db_rev, changed_rows = db.changed_since(Taskman.db_rev)
+        old_statuses = {task_id: j.status for task_id, j in Taskman.active_jobs.items()}
+
+        for task_id, name, moab_id, template_file, args_str, dead, finished, finish_msg, pending, submit_error \
+                in changed_rows:
+            j = Taskman.jobs.get(task_id)
+            if j is None:
+                j = Job(task_id, name, moab_id, None, template_file, args_str)
+                Taskman.jobs[task_id] = j
+                Taskman.index.add(j)
+            elif j.moab_id != moab_id:  # Resubmitted elsewhere
+                j.prev_moab_id = j.moab_id
+                j.moab_id = moab_id
             Taskman.jobid_nchars = max(Taskman.jobid_nchars, len(moab_id))
 
-            if moab_id in dead_tasks:
+            j.status = None
+            j.status_msg = None
+            if pending:
+                j.status = JobStatus.Pending
+            elif submit_error is not None:
+                j.status = JobStatus.Failed
+                j.status_msg = submit_error
+            elif dead:
                 j.status = JobStatus.Dead
-            elif moab_id in finished_tasks:
+            elif finished:
                 j.status = JobStatus.Finished
-                j.finish_msg = finished_tasks[moab_id][1]
-            else:
-                if statuses is None:
-                    j.status = JobStatus.Unknown  # showq has timed out
-                elif moab_id not in statuses:
-                    j.status = JobStatus.Lost
-                elif statuses[moab_id] in ['R', 'active j']:
-                    j.status = JobStatus.Running
-                elif statuses[moab_id] in ['PD', 'eligible']:
+                j.finish_msg = finish_msg
+            j.frozen = False
+            Taskman.active_jobs[task_id] = j
+
+        # Only jobs without an outcome can change state
+        lost = []
+        for j in Taskman.active_jobs.values():
+            if j.status in [JobStatus.Dead, JobStatus.Finished, JobStatus.Pending, JobStatus.Failed]:
+                continue
+            j.status_msg = None
+            if statuses is None:
+                j.status = JobStatus.Unknown  # showq has timed out
+            elif j.moab_id not in statuses:
+                if j.moab_id in Taskman.recent_submissions:  # Submitted after the snapshot was taken
                     j.status = JobStatus.Waiting
                 else:
-                    j.status = JobStatus.Other
-                    j.status_msg = statuses[moab_id].strip()
+                    j.status = JobStatus.Lost
+                    lost.append(j)
+            elif statuses[j.moab_id] in ['R', 'active']:
+                j.status = JobStatus.Running
+            elif statuses[j.moab_id] in ['PD', 'eligible']:
+                j.status = JobStatus.Waiting
+            else:
+                j.status = JobStatus.Other
+                j.status_msg = statuses[j.moab_id].strip()
+
+        # Ask the accounting what happened to jobs that left the queue without a trace. Final states are kept;
+        # jobs the accounting does not know (yet) are asked about again after a while.
+        now = time.time()
+        unknown_ids = [j.moab_id for j in lost if j.moab_id not in Taskman.accounting and
+                       now - Taskman.accounting_misses.get(j.moab_id, 0) >= QUEUE_MAX_INTERVAL]
+        if unknown_ids:
+            found = Taskman.get_accounting(unknown_ids)
+            Taskman.accounting.update(found)
+            Taskman.accounting_misses.update({moab_id: now for moab_id in unknown_ids if moab_id not in found})
+        for j in lost:
+            status, msg = Taskman.accounting.get(j.moab_id, (JobStatus.Lost, None))
+            j.status = status
+            if status == JobStatus.Finished:
+                j.finish_msg = msg
+            elif status == JobStatus.Dead:
+                j.status_msg = msg
+        return [task_id for task_id, j in Taskman.active_jobs.items() if old_statuses.get(task_id) != j.status]
 
-            jobs[task_id] = j
-        Taskman.jobs = jobs
-        Taskman.update_report()
+    @staticmethod
+    def select(query, require_name=False):
+        """Jobs matching a query, see JobIndex. Commands that cancel, remove or submit tasks require a name."""
+        return Taskman.index.select(Taskman.jobs, query, Taskman.columns, require_name)
 
     @staticmethod
-    def get_log(job, error_log=False):
+    def get_log_path(job, error_log=False, moab_id=None):
+        """Log of the job with id moab_id, by default of its last run that started"""
         ext_prefix = '.e' if error_log else '.o'
-        moab_id = job.prev_moab_id if job.status in [JobStatus.Waiting,
-                                                     JobStatus.Unknown, JobStatus.Other] else job.moab_id
-        output_filepath = HOMEDIR + '/logs/' + job.name + ext_prefix + moab_id
+        if moab_id is None:
+            moab_id = job.prev_moab_id if job.status in [JobStatus.Waiting,
+                                                         JobStatus.Unknown, JobStatus.Other] else job.moab_id
+        return HOMEDIR + '/logs/' + job.name + ext_prefix + moab_id
+
+    @staticmethod
+    def get_log(job, n_lines, error_log=False):
+        """Last n_lines lines of a log, or None if it does not exist, and its path"""
+        output_filepath = Taskman.get_log_path(job, error_log)
         try:
-            with open(output_filepath, 'r') as f:
-                lines = f.readlines()
+            with open(output_filepath, 'rb') as f:
+                lines = Taskman.read_tail(f, f.seek(0, 2), n_lines)
         except FileNotFoundError:
-            lines = None
-        return lines, output_filepath
-
-    @staticmethod
-    def update_report():
-        Taskman.columns = set()
-        for task_id, job in Taskman.jobs.items():
-            log_lines, _ = Taskman.get_log(job)
-            if log_lines is not None:
-                report_line = None
-                for line in log_lines:
-                    if line[:8] == '!taskman':
-                        report_line = line
-                if report_line is not None:
-                    job.report = json.loads(report_line[8:])
-                    Taskman.columns.update(job.report.keys())
-        if 'time' in Taskman.columns:
-            Taskman.columns.remove('time')
+            return None, output_filepath
+        return [line.decode('UTF-8', 'replace') for line in lines], output_filepath
+
+    @staticmethod
+    def read_tail(f, end, n_lines):
+        """Last n_lines lines of f[:end], the last one possibly incomplete. Only the blocks holding them are read,
+        from the end."""
+        if n_lines <= 0:
+            return []
+        blocks = []
+        n_newlines = 0
+        pos = end
+        while pos > 0:
+            start = max(0, pos - LOG_BLOCK_SIZE)
+            f.seek(start)
+            block = f.read(pos - start)
+            Taskman.metrics.log_bytes += pos - start
+            n_newlines += block.count(b'\n', 0, len(block) - 1 if pos == end else len(block))  # Not the final one
+            blocks.append(block)
+            pos = start
+            if n_newlines >= n_lines:  # The first of the lines is complete
+                break
+        lines = b''.join(reversed(blocks)).split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+        return lines[-n_lines:]
+
+    @staticmethod
+    def read_last_report(f, begin, end):
+        """Last report line (or None) of f[begin:end], read backwards block by block, and the offset just past the
+        last complete line, where the next scan starts. `begin` must be at the start of a line."""
+        complete_end = begin
+        pos = end
+        while pos > begin:
+            start = max(begin, pos - LOG_BLOCK_SIZE)
+            f.seek(start)
+            i = f.read(pos - start).rfind(b'\n')
+            Taskman.metrics.log_bytes += pos - start
+            if i >= 0:
+                complete_end = start + i + 1
+                break
+            pos = start
+
+        pos = complete_end
+        carry = b''  # Beginning of a line that started in an earlier block
+        while pos > begin:
+            start = max(begin, pos - LOG_BLOCK_SIZE)
+            f.seek(start)
+            lines = (f.read(pos - start) + carry).split(b'\n')
+            Taskman.metrics.log_bytes += pos - start
+            if start > begin:
+                carry = lines[0]
+                lines = lines[1:]
+            for line in reversed(lines):
+                if line.startswith(REPORT_PREFIX):
+                    return line, complete_end
+            pos = start
+        return None, complete_end
+
+    @staticmethod
+    def scan_report(log_file, cursor):
+        """Bring the cursor of a log file up to date. Only the bytes appended since the last scan are read."""
+        try:
+            st = stat(log_file)
+        except FileNotFoundError:
+            return None
+        if cursor is None or cursor.inode != st.st_ino or st.st_size < cursor.offset:
+            cursor = LogCursor(st.st_ino)  # New, replaced or truncated log
+        elif st.st_size == cursor.size:
+            return cursor
+
+        with open(log_file, 'rb') as f:
+            report_line, cursor.offset = Taskman.read_last_report(f, cursor.offset, st.st_size)
+        cursor.size = st.st_size
+        if report_line is not None:
+            cursor.report = json.loads(report_line[len(REPORT_PREFIX):].decode('UTF-8'))
+        return cursor
+
+    @staticmethod
+    def update_report(task_ids=None):
+        """Update the reports of the jobs that are not frozen, only of those of task_ids if given. A job that has
+        ended is frozen once its log stops growing: its report is kept and its log is not read anymore."""
+        old_cursors = Taskman.log_cursors
+        if task_ids is None:
+            Taskman.log_cursors = {}  # Forget logs of jobs that are gone or frozen
+            columns = set()
+            jobs = list(Taskman.active_jobs.items())
+        else:
+            columns = set(Taskman.columns)
+            jobs = [(task_id, Taskman.active_jobs[task_id]) for task_id in task_ids if task_id in Taskman.active_jobs]
+        for task_id, job in jobs:
+            log_file = Taskman.get_log_path(job)
+            cursor = old_cursors.get(log_file)
+            old_size = None if cursor is None else cursor.size
+            cursor = Taskman.scan_report(log_file, cursor)
+            if cursor is not None:
+                Taskman.log_cursors[log_file] = cursor
+                if cursor.report is not None:
+                    job.report = cursor.report
+                if Taskman.series is not None and cursor.size != old_size:
+                    Taskman.series.ingest(task_id, log_file)
+
+            ended = job.status in [JobStatus.Dead, JobStatus.Finished] and not job.report.get('resubmit', False)
+            if ended and (cursor is None or cursor.size == old_size):
+                job.frozen = True
+                del Taskman.active_jobs[task_id]
+                Taskman.log_cursors.pop(log_file, None)
+                Taskman.frozen_columns.update(job.report.keys())
+            else:
+                columns.update(job.report.keys())
+        Taskman.columns = (columns | Taskman.frozen_columns) - {'time'}
 
     @staticmethod
     def resume_incomplete_tasks():
-        for task_id, job in Taskman.jobs.items():
-            if job.status != JobStatus.Finished:
-                continue
-            do_resubmit = job.report.get('resubmit', False)
-            if do_resubmit:
-                Taskman.submit(job)
-        time.sleep(2)
+        """Resubmit the tasks whose last report asks for it. Returns whether any task was resubmitted."""
+        promoted = Taskman.follow_chains() if CHAIN_MODE else []
+        to_resubmit = [job for job in Taskman.active_jobs.values()
+                       if job.status == JobStatus.Finished and job.report.get('resubmit', False)]
+        if to_resubmit:
+            Taskman.enqueue(to_resubmit)
+        if CHAIN_MODE:
+            Taskman.chain_continuations()
+        return bool(promoted or to_resubmit)
+
+    @staticmethod
+    def follow_chains():
+        """Tasks whose segment succeeded and asked for resubmission continue with their pre-queued next segment,
+        which the scheduler has started already. Other next segments are cancelled, as soon as the report of the
+        running segment stops asking for resubmission. Returns the continued jobs."""
+        db = Taskman.get_db()
+        promoted, to_cancel, resolved = [], [], []
+        for task_id, (parent_id, moab_id) in db.get_chains().items():
+            job = Taskman.jobs.get(task_id)
+            if job is None or job.moab_id != parent_id:  # Removed, or resubmitted by other means
+                to_cancel.append(moab_id)
+                resolved.append(task_id)
+            elif job.status == JobStatus.Finished and job.finish_msg != 'cancel' and job.report.get('resubmit', False):
+                job.prev_moab_id = job.moab_id
+                job.moab_id = moab_id
+                job.status = JobStatus.Waiting
+                promoted.append(job)
+            elif job.status in [JobStatus.Dead, JobStatus.Finished] or \
+                    job.status in [JobStatus.Running, JobStatus.Waiting] and not job.report.get('resubmit', False):
+                to_cancel.append(moab_id)
+                resolved.append(task_id)
+        if promoted:
+            db.promote_chains(promoted)
+            Taskman.queue_changed()
+            for job in promoted:
+                print('Continued.  TaskmanID: {}  Moab/SLURM ID: {}'.format(job.task_id, job.moab_id))
+        if to_cancel:
+            Taskman.cancel_continuations(to_cancel)
+            db.remove_chains(resolved)
+        return promoted
+
+    @staticmethod
+    def chain_continuations():
+        """Queue the next segment of the running and waiting tasks whose report asks for resubmission, held by the
+        scheduler until the current segment has succeeded"""
+        chains = Taskman.get_db().get_chains()
+        jobs = [job for job in Taskman.active_jobs.values() if job.status in [JobStatus.Running, JobStatus.Waiting]
+                and job.report.get('resubmit', False) and job.task_id not in chains]
+        capacity = Taskman.queue_capacity()
+        if capacity is None or not jobs:
+            return
+        if capacity >= 0:
+            jobs = jobs[:capacity]
+        scheduler = Taskman.scheduler
+        with ThreadPoolExecutor(SUBMIT_WORKERS) as pool:
+            outputs = list(pool.map(scheduler.try_run, [
+                scheduler.submit_args(scheduler.dependency_args(job.moab_id) + [job.script_file]) for job in jobs]))
+        entries = [(job.task_id, job.moab_id, scheduler.parse_submit(output))
+                   for job, (output, failed) in zip(jobs, outputs) if output is not None and not failed]
+        if entries:
+            Taskman.get_db().add_chains(entries)
+            Taskman.recent_submissions.update({moab_id: time.time() for _, _, moab_id in entries})
+            Taskman.queue_changed()
+
+    @staticmethod
+    def cancel_continuations(moab_ids):
+        """Cancel pre-queued segments. Errors are ignored: the segment may have ended already."""
+        with ThreadPoolExecutor(SUBMIT_WORKERS) as pool:
+            list(pool.map(Taskman.scheduler.try_run, [args for _, args in Taskman.scheduler.cancel_commands(moab_ids)]))
 
     @staticmethod
     def show_status():
-        print('\033[2J\033[H')  # Clear screen and move cursor to top left
-        print('\033[97;45m( Experiment Manager )\033[0m     ' + time.strftime("%H:%M:%S"), end='')
-        print('     \033[37mCtrl+C to enter command mode\033[0m')
-
-        line_fmt = '{:<8} {:<30} {:<21} {:<' + str(Taskman.jobid_nchars) + '} {:<7}' + ' {:<12}' * len(Taskman.columns)
-        print('\033[1m' + line_fmt.format('Status', 'Task name', 'Task id', 'Moab id', 'Updated',
-                                          *sorted(Taskman.columns)) + '\033[0m')
-        
-        waiting_tasks = [j for j in Taskman.jobs.values() if j.status == JobStatus.Waiting or j.status_msg == 'blocked']
-        non_waiting_tasks = [j for j in Taskman.jobs.values() if j not in waiting_tasks]
-        
-        def print_job_line(job):
+        screen = Taskman.screen
+        header = '\033[97;45m( Experiment Manager )\033[0m     ' + time.strftime("%H:%M:%S")
+        if Taskman.queue_time is not None and time.time() - Taskman.queue_time > 2 * QUEUE_CACHE_TTL:
+            header += '     \033[33mQueue from {} ago\033[0m'.format(fmt_time(time.time() - Taskman.queue_time))
+        n_pending = sum(j.status == JobStatus.Pending for j in Taskman.jobs.values())
+        if n_pending:
+            header += '     {} pending{}'.format(n_pending, ' (max {} queued)'.format(MAX_QUEUED) if MAX_QUEUED else '')
+        n_failed = sum(j.status == JobStatus.Failed for j in Taskman.jobs.values())
+        if n_failed:
+            header += '     \033[31m{} could not be submitted, see show\033[0m'.format(n_failed)
+        jobs = Taskman.select(screen.query) if screen.query else Taskman.jobs.values()
+        if screen.query:
+            header += '     \033[36mFilter: {} ({} of {} tasks)\033[0m'.format(screen.query, len(jobs),
+                                                                               len(Taskman.jobs))
+        header += '     \033[37mCtrl+C to enter command mode\033[0m'
+        columns = sorted(Taskman.columns)
+        line_fmt = '{:<8} {:<30} {:<21} {:<' + str(Taskman.jobid_nchars) + '} {:<7}' + ' {:<12}' * len(columns)
+        rows = [header, '\033[1m' + line_fmt.format('Status', 'Task name', 'Task id', 'Moab id', 'Updated',
+                                                    *columns) + '\033[0m']
+
+        # Waiting tasks go after the others
+        waiting_tasks, non_waiting_tasks = [], []
+        for j in jobs:
+            is_waiting = j.status in [JobStatus.Waiting, JobStatus.Pending] or j.status_msg == 'blocked'
+            (waiting_tasks if is_waiting else non_waiting_tasks).append(j)
+        sort_key = screen.sort_key()
+        waiting_tasks.sort(key=sort_key, reverse=screen.reverse)
+        non_waiting_tasks.sort(key=sort_key, reverse=screen.reverse)
+        n_pages = max(1, math.ceil(len(jobs) / MAX_LINES))
+        screen.page = min(screen.page, n_pages - 1)
+        start = screen.page * MAX_LINES
+        n_non_waiting = len(non_waiting_tasks)
+        shown = (non_waiting_tasks[start:start + MAX_LINES] +
+                 waiting_tasks[max(0, start - n_non_waiting):max(0, start + MAX_LINES - n_non_waiting)])
+
+        def format_job_line(job):
             # Get report data
             report_columns = []
-            for k in sorted(Taskman.columns):
+            for k in columns:
                 val_str = str(job.report.get(k, ''))[:12]
                 report_columns.append(val_str)
             time_ago = fmt_time(time.time() - job.report['time']) if 'time' in job.report else ''
@@ -365,38 +2412,73 @@ class Taskman(object):
                                    'cancel': '\033[;107mCancel\'d'  # Black
                                    }.get(job.finish_msg, '\033[;107mFinished')
                 status_line = finished_status + status_line[8:] + '\033[0m'
-            print(status_line)
+            return status_line
 
-        for job in list(sorted(non_waiting_tasks, key=lambda x: x.name))[:MAX_LINES]:
-            print_job_line(job)
-        if len(non_waiting_tasks) < MAX_LINES:
-            for job in list(sorted(waiting_tasks, key=lambda x: x.name))[:MAX_LINES - len(non_waiting_tasks)]:
-                print_job_line(job)
-        if len(Taskman.jobs) > MAX_LINES:
-            total_not_shown = len(Taskman.jobs) - MAX_LINES
-            print('[ ... {} tasks not shown - {} waiting/blocked tasks in total ... ]'.format(total_not_shown,
-                                                                                      len(waiting_tasks)))
-            
+        rows += [format_job_line(job) for job in shown]
+        if METRICS_FOOTER:
+            rows.append('\033[37m' + Taskman.metrics.footer() + '\033[0m')
+        if n_pages > 1:
+            rows.append('[ page {}/{} - {} tasks - {} waiting/blocked - sorted by {}{} - commands: page, sort, filter ]'
+                        .format(screen.page + 1, n_pages, len(jobs), len(waiting_tasks), screen.sort_column,
+                                ' (desc)' if screen.reverse else ''))
+        screen.draw(rows)
 
     @staticmethod
-    def update(resume_incomplete_tasks=True):
-        Taskman.process_bucket()
-        Taskman.update_job_list()
-        Taskman.show_status()
-        if resume_incomplete_tasks:
-            Taskman.resume_incomplete_tasks()
+    def update(resume_incomplete_tasks=True, stages=None):
+        """Refresh the stages affected by changes ('bucket', 'queue', 'jobs', 'logs'), or all of them if stages is
+        None. The queue is also polled when it is due. Admission and the job list follow the bucket, the queue and
+        the task database; the reports follow the logs. The dashboard is redrawn every time."""
+        metrics = Taskman.metrics
+        if stages is None:
+            stages = {'bucket', 'queue', 'jobs', 'logs'}
+        if 'bucket' in stages:
+            with metrics.phase('bucket'):
+                Taskman.process_bucket()
+        if 'queue' in stages or time.time() >= Taskman.next_queue_poll:
+            with metrics.phase('queue'):
+                Taskman.set_queue(Taskman.get_queue())
+            stages = stages | {'queue'}
+        refresh_jobs = bool(stages & {'bucket', 'queue', 'jobs'})
+        changed = []
+        if refresh_jobs:
+            with metrics.phase('admit'):
+                Taskman.admit()
+            with metrics.phase('jobs'):
+                changed = Taskman.sync_job_list(Taskman.statuses)  # Only reads what changed in the database
+        if 'logs' in stages:
+            with metrics.phase('logs'):
+                Taskman.update_report()  # Only reads what was appended to the logs
+        elif changed:
+            # Resuming a job that just ended depends on its last report, which the scan of the logs may not have
+            # seen yet: the watcher holds that stage back
+            with metrics.phase('logs'):
+                Taskman.update_report(changed)
+        with metrics.phase('render'):
+            Taskman.show_status()
+        resubmitted = False
+        if resume_incomplete_tasks and (refresh_jobs or 'logs' in stages):
+            with metrics.phase('resume'):
+                resubmitted = Taskman.resume_incomplete_tasks()
+        metrics.flush()
+        if resubmitted:
+            time.sleep(2)
 
 
 def _handle_command(cmd_str):
+    """Run a command typed at the prompt. Its errors are printed, so that a typo does not stop the monitor."""
     tokens = cmd_str.split(' ')
     cmd_name = tokens[0]
     if cmd_name == '':
         return
-    if len(tokens) == 1:
-        cmds[cmd_name]()
-    else:
-        cmd_args = ' '.join(tokens[1:])
-        cmds[cmd_name](*cmd_args.split(';'))
+    try:
+        if len(tokens) == 1:
+            cmds[cmd_name]()
+        else:
+            cmd_args = ' '.join(tokens[1:])
+            cmds[cmd_name](*cmd_args.split(';'))
+    except Exception as e:
+        print('Error in command {!r}: {!r}'.format(cmd_str, e))
+        time.sleep(3)
 
 
 def _show_commands():
@@ -408,25 +2490,26 @@ def _show_commands():
         print(name, ':', '; '.join([str(p) for p in params]))
 
 
-def _match(pattern, name):
-    if pattern.endswith('*'):
-        return name.startswith(pattern[:-1])
-    else:
-        return name == pattern
+def _glob_escape(s):
+    return ''.join('[' + c + ']' if c in '*?[' else c for c in s)
 
 
-def submit(template_file, args_str, task_name):
+def submit(template_file, args_str, task_name, priority='0'):
     job = Taskman.create_task(template_file, args_str, task_name)
-    Taskman.submit(job)
+    Taskman.enqueue([job], int(priority))
 
 
 def fromckpt(template_file, args_str, task_name, ckpt_file):
     job = Taskman.create_task(template_file, args_str, task_name)
-    print('Moving checkpoint...')
+    print('Storing checkpoint...')
+    manifest = Taskman.ckpt_store.add(HOMEDIR + '/' + ckpt_file, ckpt_file)
     job_dir = CKPT_FOLDER + '/' + job.name + '/' + job.task_id
     makedirs(job_dir)
-    shutil.move(HOMEDIR + '/' + ckpt_file, job_dir)
-    Taskman.submit(job)
+    methods = Taskman.ckpt_store.place(manifest, job_dir, move=True)  # Placed once: no need to keep a copy
+    print('Placed {} checkpoint files ({})'.format(len(methods), ', '.join(sorted(set(methods)))))
+    if 'hardlink' in methods or 'symlink' in methods:
+        print('They are shared with the store: the job must replace them, not rewrite them in place')
+    Taskman.enqueue([job])
 
 
 def multi_sub():
@@ -444,87 +2527,258 @@ def multi_sub():
     print()
     r = input('Submit? (y/n)')
     if r == 'y':
-        for i in a:
-            submit(*i.split(';'))
+        Taskman.enqueue(Taskman.create_tasks([i.split(';') for i in a]))
 
 
 def continu(task_name):
-    for task_id, job in Taskman.jobs.items():
-        if (job.status in [JobStatus.Dead, JobStatus.Lost] or job.status == JobStatus.Finished
-                and job.finish_msg == 'cancel') and _match(task_name, job.name):
-            Taskman.submit(job)
+    jobs = [job for job in Taskman.select(task_name, require_name=True)
+            if job.status in [JobStatus.Dead, JobStatus.Lost, JobStatus.Failed] or job.status == JobStatus.Finished
+            and job.finish_msg == 'cancel']
+    Taskman.enqueue(jobs)
 
 
 def cancel(task_name):
-    for task_id, job in Taskman.jobs.items():
-        if job.status.cancellable and _match(task_name, job.name):
-            Taskman.cancel(task_id)
+    Taskman.cancel_many([job.task_id for job in Taskman.select(task_name, require_name=True)
+                         if job.status.cancellable])
 
 
 def copy(task_name):
-    submitted = set()
-    for task_id, job in Taskman.jobs.items():
-        if job.name not in submitted and _match(task_name, job.name):
-            job = Taskman.create_task(job.template_file, job.args_str, job.name)
-            Taskman.submit(job)
-            submitted.add(job.name)
+    sources = {}
+    for job in Taskman.select(task_name, require_name=True):
+        if job.name not in sources:
+            sources[job.name] = job
+    jobs = Taskman.create_tasks([(j.template_file, j.args_str, j.name) for j in sources.values()])
+    for source, job in zip(sources.values(), jobs):
+        # Start from the same checkpoint as the original
+        Taskman.ckpt_store.copy_manifest(CKPT_FOLDER + '/' + source.name + '/' + source.task_id,
+                                         CKPT_FOLDER + '/' + job.name + '/' + job.task_id)
+    Taskman.enqueue(jobs)
 
 
 def show(task_name):
     print()
-    for task_id, job in Taskman.jobs.items():
-        if _match(task_name, job.name):
-            out_log, out_log_file = Taskman.get_log(job)
-            err_log, err_log_file = Taskman.get_log(job, error_log=True)
-
-            print('\033[1m' + job.name + '\033[0m :', job.args_str)
-            print('\033[30;44m' + ' ' * 40 + '\033[0m ' + out_log_file + '\r\033[2C Output ')
-            if out_log is not None:
-                for l in out_log[-20:]:
-                    print(l.strip())
-            print('\033[30;44m' + ' ' * 40 + '\033[0m ' + err_log_file + '\r\033[2C Error ')
-            if err_log is not None:
-                for l in err_log[-30:]:
-                    print(l.strip())
-            print('\033[30;44m' + ' ' * 40 + '\033[0m')
-            print()
+    for job in Taskman.select(task_name):
+        out_log, out_log_file = Taskman.get_log(job, 20)
+        err_log, err_log_file = Taskman.get_log(job, 30, error_log=True)
+
+        print('\033[1m' + job.name + '\033[0m :', job.args_str)
+        if job.status == JobStatus.Failed:
+            print('\033[31mCould not be submitted:\033[0m', job.status_msg)
+        print('\033[30;44m' + ' ' * 40 + '\033[0m ' + out_log_file + '\r\033[2C Output ')
+        if out_log is not None:
+            for l in out_log:
+                print(l.strip())
+        print('\033[30;44m' + ' ' * 40 + '\033[0m ' + err_log_file + '\r\033[2C Error ')
+        if err_log is not None:
+            for l in err_log:
+                print(l.strip())
+        print('\033[30;44m' + ' ' * 40 + '\033[0m')
+        print()
+    input('Press any key...')
+
+
+def follow(task_name, lines='10'):
+    """Print the logs of the matching jobs as they grow, each line prefixed with its log, until Enter is pressed"""
+    logs = []
+    for job in Taskman.select(task_name):
+        for error_log in [False, True]:
+            logs.append(FollowedLog(Taskman.get_log_path(job, error_log, job.moab_id),
+                                    short_str(job.name, 30) + ('.e' if error_log else '.o') + job.moab_id))
+    width = max([len(log.label) for log in logs], default=0)
+    colors = ['36', '32', '35', '34', '33', '96', '92', '95', '94', '93']
+
+    def print_lines(i, log, new_lines):
+        prefix = '\033[{}m{}\033[0m | '.format(colors[i // 2 % len(colors)], log.label.ljust(width))
+        for line in new_lines:
+            print(prefix + line.rstrip('\r'))
+
+    print()
+    for i, log in enumerate(logs):
+        print_lines(i, log, log.start(int(lines)))
+    print('\033[1mFollowing {} logs, press Enter to stop\033[0m'.format(len(logs)))
+    try:
+        while True:
+            for i, log in enumerate(logs):
+                print_lines(i, log, log.poll())
+            sys.stdout.flush()
+            if select.select([sys.stdin], [], [], FOLLOW_INTERVAL)[0]:
+                sys.stdin.readline()
+                break
+    except KeyboardInterrupt:
+        pass
+
+
+def curve(task_name, key=None):
+    if Taskman.series is None:
+        print('The report history is disabled, set TASKMAN_SERIES to a folder to record it')
+        return
+    print()
+    for job in Taskman.select(task_name):
+        columns = Taskman.series.load(job.task_id)
+        if key is None:
+            n_rows = len(columns['time']) if columns else 0
+            print('{:<30} {:<26} {:>6} reports  {}'.format(short_str(job.name, 30), job.task_id, n_rows,
+                                                            ' '.join(k for k in columns if k != 'time')))
+            continue
+        values = [v for v in columns.get(key, []) if not math.isnan(v)]
+        if not values:
+            print('{:<30} {:<26} no {}'.format(short_str(job.name, 30), job.task_id, key))
+            continue
+        print('{:<30} {:<26} {:>6} points  first {:<10.4g} last {:<10.4g} min {:<10.4g} max {:<10.4g} {}'.format(
+            short_str(job.name, 30), job.task_id, len(values), values[0], values[-1], min(values), max(values),
+            _sparkline(values, 40)))
     input('Press any key...')
 
 
+def _sparkline(values, width):
+    ticks = '▁▂▃▄▅▆▇█'
+    if len(values) > width:
+        values = [values[(i * (len(values) - 1)) // (width - 1)] for i in range(width)]
+    low, high = min(values), max(values)
+    scale = (len(ticks) - 1) / (high - low) if high > low else 0
+    return ''.join(ticks[round((v - low) * scale)] for v in values)
+
+
 def pack(task_name):
     checkpoint_paths = []
-    for task_id, job in Taskman.jobs.items():
-        if job.status == JobStatus.Finished and _match(task_name, job.name):
+    for job in Taskman.select(task_name):
+        if job.status == JobStatus.Finished:
             checkpoint_paths.append(job.name + '/' + job.task_id)
     # Call pack.sh
     subprocess.Popen([HOMEDIR + '/taskman/pack.sh'] + checkpoint_paths)
 
 
 def results(task_name):
-    files = []
-    for task_id, job in Taskman.jobs.items():
-        if job.status == JobStatus.Finished and _match(task_name, job.name):
-            filepath = job.name + '/' + job.task_id + '/results.csv'
-            files.append(filepath)
-    # Call pack.sh
-    subprocess.Popen([HOMEDIR + '/taskman/packresults.sh'] + files)
+    jobs = [job for job in Taskman.select(task_name) if job.status == JobStatus.Finished]
+    tables = {}
+    summaries = Taskman.read_results(jobs, tables)
+    jobs = [job for job in jobs if job.task_id in summaries]
+
+    # Result columns in order of first appearance
+    columns = []
+    for job in jobs:
+        columns += [c for c in summaries[job.task_id]['header'] if c not in columns]
+
+    # One row per result row, prefixed with the task. The rows of the tasks merged already are kept as long as
+    # the columns and their results.csv files are the same: only the rows of the new tasks are appended.
+    makedirs(RESULTS_FOLDER, exist_ok=True)
+    label = re.sub(r'[^\w.-]+', '_', task_name.rstrip('*')).strip('_') or 'all'
+    out_file = RESULTS_FOLDER + '/' + label + '.csv'
+    merged_file = RESULTS_FOLDER + '/.' + label + '.json'  # Columns, tasks and size of out_file
+    stamps = {job.task_id: summaries[job.task_id]['stamp'] for job in jobs}
+    try:
+        with open(merged_file, 'r') as f:
+            merged = json.load(f)
+        out_size = stat(out_file).st_size
+    except (FileNotFoundError, ValueError):
+        merged, out_size = {}, None
+    if merged.get('columns') == columns and merged.get('size') == out_size and \
+            all(stamps.get(task_id) == stamp for task_id, stamp in merged['tasks'].items()):
+        new_jobs = [job for job in jobs if job.task_id not in merged['tasks']]
+        mode = 'a'
+    else:
+        new_jobs = jobs
+        mode = 'w'
 
+    def read(job):
+        try:
+            return Taskman.read_result_table(job)
+        except FileNotFoundError:  # Removed since it was summarized
+            return None
 
-def _clean(task_name=None, clean_all=False):
-    shutil.copyfile(DB_STARTED_TASKS,
-                    HOMEDIR + '/taskman/old/started_' + datetime.now().strftime("%m-%d_%H-%M-%S"))
+    # The tables summarized just now were read already, the others are read in parallel
+    unread = [job for job in new_jobs if job.task_id not in tables]
+    with ThreadPoolExecutor(SUBMIT_WORKERS) as pool:
+        tables.update(zip([job.task_id for job in unread], pool.map(read, unread)))
+    with open(out_file if mode == 'a' else out_file + '.tmp', mode, newline='') as f:
+        writer = csv.writer(f)
+        if mode == 'w':
+            writer.writerow(['task_name', 'task_id', 'args'] + columns)
+        for job in new_jobs:
+            if tables[job.task_id] is None:
+                stamps.pop(job.task_id)
+                continue
+            header, rows = tables[job.task_id]
+            positions = [header.index(c) if c in header else None for c in columns]
+            for row in rows:
+                writer.writerow([job.name, job.task_id, job.args_str] +
+                                [row[i] if i is not None and i < len(row) else '' for i in positions])
+    if mode == 'w':
+        replace(out_file + '.tmp', out_file)
+    with open(merged_file + '.tmp', 'w') as f:
+        json.dump({'columns': columns, 'tasks': stamps, 'size': stat(out_file).st_size}, f)
+    replace(merged_file + '.tmp', merged_file)
+
+    # Statistics by task name, from the moments of each task
+    groups = {}
+    for job in jobs:
+        group = groups.setdefault(job.name, {'tasks': 0, 'moments': {}})
+        group['tasks'] += 1
+        for column, moments in summaries[job.task_id]['moments'].items():
+            group['moments'][column] = _merge_moments(group['moments'].get(column), moments)
+    stats_file = RESULTS_FOLDER + '/' + label + '_stats.csv'
+    print()
+    with open(stats_file + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['task_name', 'column', 'tasks', 'count', 'mean', 'std', 'min', 'max'])
+        for name, group in sorted(groups.items()):
+            print('\033[1m' + name + '\033[0m', group['tasks'], 'tasks')
+            for column in columns:
+                if column not in group['moments']:
+                    continue
+                count, mean, m2, low, high = group['moments'][column]
+                stats = count, mean, math.sqrt(m2 / count), low, high
+                writer.writerow([name, column, group['tasks']] + list(stats))
+                print('    {:<30} n={:<6} mean {:<10.4g} std {:<10.4g} min {:<10.4g} max {:<10.4g}'.format(
+                    short_str(column, 30), *stats))
+    replace(stats_file + '.tmp', stats_file)
+    print('{} tasks merged into {} ({} new), statistics in {}'.format(len(jobs), out_file, len(new_jobs),
+                                                                       stats_file))
+    input('Press any key...')
+
+
+def _column_moments(values):
+    """Count, mean, sum of squared deviations from the mean, min and max of the numeric values of a column, or None
+    if there are none. Moments of different tasks are combined with _merge_moments."""
+    numbers = []
+    for value in values:
+        try:
+            number = float(value)
+        except ValueError:
+            continue
+        if not math.isnan(number):
+            numbers.append(number)
+    if not numbers:
+        return None
+    mean = math.fsum(numbers) / len(numbers)
+    return len(numbers), mean, math.fsum((x - mean) ** 2 for x in numbers), min(numbers), max(numbers)
+
+
+def _merge_moments(a, b):
+    """Moments of the union of two sets of values (pairwise update of Chan et al.). `a` may be None."""
+    if a is None:
+        return b
+    n_a, mean_a, m2_a, min_a, max_a = a
+    n_b, mean_b, m2_b, min_b, max_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    return n, mean, m2_a + m2_b + delta * delta * n_a * n_b / n, min(min_a, min_b), max(max_a, max_b)
 
-    started_tasks, dead_tasks, finished_tasks = Taskman.read_task_db()
 
-    with open(DB_STARTED_TASKS, 'w') as f:
-        for task_id, fields in started_tasks.items():
-            name, moab_id, template_file, args_str = fields
-            remove = clean_all or (moab_id in dead_tasks or moab_id in finished_tasks)
-            if task_name is not None:
-                remove = _match(task_name, name) and remove
-            if not remove:
-                job = Job(task_id, name, moab_id, None, template_file, args_str)
-                Taskman.write_started(job, f)
+def _clean(task_name=None, clean_all=False):
+    task_ids = {job.task_id for job in Taskman.select(task_name, require_name=True)} if task_name is not None else None
+    removed = Taskman.get_db().remove(task_ids, clean_all)
+    chained_ids = [row[8] for row in removed if row[8]]
+    if chained_ids:  # Nothing would follow them anymore
+        Taskman.cancel_continuations(chained_ids)
+    if Taskman.series is not None:
+        Taskman.series.remove([row[0] for row in removed])
+
+    # Keep the removed tasks in the old 'started' format, in case they are needed again
+    with open(HOMEDIR + '/taskman/old/started_' + datetime.now().strftime("%m-%d_%H-%M-%S"), 'w') as f:
+        for row in removed:
+            f.write(';'.join(row[:5]) + '\n')
 
 
 def clean(task_name=None):
@@ -536,10 +2790,35 @@ def cleanall(task_name=None):
 
 
 def regen_script(task_name):
-    for task_id, job in Taskman.jobs.items():
-        if _match(task_name, job.name):
-            script = Taskman.generate_script(job)
-            print('Regenerated', script)
+    jobs = Taskman.select(task_name, require_name=True)
+    for script in Taskman.generate_scripts(jobs):
+        print('Regenerated', script)
+
+
+def page(number='+'):
+    """Show the next (+) or previous (-) page of the dashboard, or page `number`"""
+    screen = Taskman.screen
+    if number == '+':
+        screen.page += 1
+    elif number == '-':
+        screen.page = max(0, screen.page - 1)
+    else:
+        screen.page = max(0, int(number) - 1)
+
+
+def sort(column='name', order='asc'):
+    """Sort the dashboard by name, status, id, updated or a report column"""
+    Taskman.screen.sort_column = column
+    Taskman.screen.reverse = order == 'desc'
+    Taskman.screen.page = 0
+
+
+def filter_jobs(query=''):
+    """Only show the tasks matching a query on the dashboard, e.g. 'sweep* status=Finished val_acc>0.9'. An
+    empty query shows all of them again."""
+    Taskman.select(query)  # Raise bad queries now rather than on every draw
+    Taskman.screen.query = query.strip() or None
+    Taskman.screen.page = 0
 
 
 def short_str(x, l):
@@ -551,23 +2830,229 @@ def short_str(x, l):
     return x[:left_side] + '..' + x[-right_side:]
 
 
+class Monitor(object):
+    """Event loop mode. The queue, the logs and the bucket are refreshed by independent tasks, the dashboard is
+    redrawn whenever one of them has news, and Ctrl+C opens the command prompt right away."""
+
+    def __init__(self):
+        self.state_lock = None  # Held while Taskman.jobs is modified or iterated, and while the task database is used
+        self.queue_wanted = None
+        self.jobs_changed = None
+        self.logs_changed = None
+        self.bucket_changed = None
+        self.dirty = None
+        self.command_mode = False
+        self.stopped = None
+
+    @staticmethod
+    async def get_cmd_output(args, timeout=20):
+        start = time.time()
+        proc = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            output, _ = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            Taskman.record_command(args, start, 'timeout')
+            return None
+        if proc.returncode != 0:
+            Taskman.record_command(args, start, 'error', output)
+            raise subprocess.CalledProcessError(proc.returncode, args, output)
+        Taskman.record_command(args, start, 'ok')
+        return output.decode('UTF-8')
+
+    @staticmethod
+    async def input(prompt):
+        """input() in a daemon thread, which does not keep the process alive on exit"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def read():
+            try:
+                result = input(prompt)
+            except EOFError as e:
+                loop.call_soon_threadsafe(future.set_exception, e)
+            else:
+                loop.call_soon_threadsafe(future.set_result, result)
+        threading.Thread(target=read, daemon=True).start()
+        return await future
+
+    @staticmethod
+    async def wait_event(event, timeout):
+        """Wait until the event is set or the timeout expires, then clear it"""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    async def poll_queue(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self.state_lock:
+                commands, parse, ids = Taskman.scheduler.queue_commands(Taskman.queue_ids())
+
+            def query():  # In the thread of fetch, which waits for the query run by the event loop
+                with Taskman.metrics.phase('queue'):
+                    return asyncio.run_coroutine_threadsafe(self.query_queue(commands, parse), loop).result()
+
+            snapshot = await asyncio.to_thread(Taskman.queue_cache.fetch, ids, query, Taskman.queue_min_time)
+            Taskman.set_queue(Taskman.use_snapshot(snapshot))
+            self.jobs_changed.set()
+            while time.time() < Taskman.next_queue_poll:  # Submissions and cancellations move the next poll closer
+                await self.wait_event(self.queue_wanted, Taskman.next_queue_poll - time.time())
+
+    async def query_queue(self, commands, parse):
+        scheduler = Taskman.scheduler
+        for args in commands:
+            try:
+                if scheduler.in_process:
+                    output = await asyncio.to_thread(scheduler.run, args, 10)
+                else:
+                    output = await self.get_cmd_output(args, timeout=10)
+            except subprocess.CalledProcessError:
+                continue
+            if output is None:
+                return None
+            statuses = Taskman.try_parse(parse, args, output)
+            if statuses is not None:
+                return statuses
+        return None
+
+    async def watch(self):
+        watcher = ChangeWatcher(Taskman.get_db())
+        events = {'bucket': self.bucket_changed, 'jobs': self.jobs_changed, 'logs': self.logs_changed}
+        while True:
+            async with self.state_lock:  # Other stages use the task database from worker threads meanwhile
+                changes = watcher.changes()
+            for stage in changes:
+                events[stage].set()
+            await asyncio.sleep(1)
+
+    async def refresh_jobs(self):
+        while True:
+            await self.jobs_changed.wait()
+            self.jobs_changed.clear()
+            if Taskman.next_queue_poll == 0:
+                self.queue_wanted.set()
+            metrics = Taskman.metrics
+            async with self.state_lock:
+                with metrics.phase('admit'):
+                    await asyncio.to_thread(Taskman.admit)
+                with metrics.phase('jobs'):
+                    await asyncio.to_thread(Taskman.sync_job_list, Taskman.statuses)
+                with metrics.phase('logs'):
+                    await asyncio.to_thread(Taskman.update_report)
+                if not self.command_mode:
+                    with metrics.phase('resume'):
+                        await asyncio.to_thread(Taskman.resume_incomplete_tasks)
+            self.dirty.set()
+
+    async def scan_logs(self):
+        while True:
+            await self.wait_event(self.logs_changed, REFRESH_INTERVAL)
+            async with self.state_lock:
+                with Taskman.metrics.phase('logs'):
+                    await asyncio.to_thread(Taskman.update_report)
+            self.dirty.set()
+
+    async def ingest_bucket(self):
+        while True:
+            async with self.state_lock:
+                with Taskman.metrics.phase('bucket'):
+                    await asyncio.to_thread(Taskman.process_bucket)
+            self.jobs_changed.set()
+            if not Taskman.bucket.backlog:
+                await self.wait_event(self.bucket_changed, REFRESH_INTERVAL)
+
+    async def render(self):
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            if not self.command_mode:
+                async with self.state_lock:  # Workers of the other stages add jobs while they hold it
+                    with Taskman.metrics.phase('render'):
+                        Taskman.show_status()
+                Taskman.metrics.flush()
+
+    async def command_prompt(self):
+        self.command_mode = True
+        print()
+        _show_commands()
+        try:
+            command = await self.input('\033[1mCommand>>\033[0m ')
+        except EOFError:
+            self.stopped.set()
+            return
+        async with self.state_lock:
+            await asyncio.to_thread(_handle_command, command)
+        Taskman.screen.invalidate()
+        self.command_mode = False
+        self.jobs_changed.set()
+
+    def on_interrupt(self):
+        if self.command_mode:
+            self.stopped.set()  # Ctrl+C at the prompt quits, like in the blocking mode
+        else:
+            asyncio.ensure_future(self.command_prompt())
+
+    async def main(self):
+        self.state_lock = asyncio.Lock()
+        self.queue_wanted = asyncio.Event()
+        self.jobs_changed = asyncio.Event()
+        self.logs_changed = asyncio.Event()
+        self.bucket_changed = asyncio.Event()
+        self.dirty = asyncio.Event()
+        self.stopped = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, self.on_interrupt)
+
+        stages = [self.poll_queue(), self.watch(), self.refresh_jobs(), self.scan_logs(), self.render()]
+        if BUCKET_FOLDER is not None:
+            stages.append(self.ingest_bucket())
+        stages = [asyncio.ensure_future(c) for c in stages]
+        done, _ = await asyncio.wait(stages + [asyncio.ensure_future(self.stopped.wait())],
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for stage in stages:
+            stage.cancel()
+        for task in done:
+            task.result()  # Raise the error of a failed stage
+
+    def run(self):
+        asyncio.run(self.main())
+
+
 # Available commands
 cmds = {'sub': submit, 'fromckpt': fromckpt, 'multisub': multi_sub, 'cont': continu, 'cancel': cancel, 'copy': copy,
-        'pack': pack, 'results': results, 'show': show, 'clean': clean, 'cleanall': cleanall, 'regen': regen_script}
+        'pack': pack, 'results': results, 'show': show, 'clean': clean, 'cleanall': cleanall, 'regen': regen_script,
+        'page': page, 'sort': sort, 'curve': curve, 'filter': filter_jobs, 'follow': follow}
 
 
 if __name__ == '__main__':
+    if '--async' in sys.argv[1:]:
+        Monitor().run()
+        sys.exit()
+
+    watcher = ChangeWatcher(Taskman.get_db())
+    stages = None
     while True:
         command_mode = False
         try:
-            Taskman.update()
-            time.sleep(120)
+            Taskman.update(stages=stages)
+            # Wake up early when something changes on disk, and at least every REFRESH_INTERVAL. Bucket lines left
+            # over by the last refresh are submitted right away.
+            timeout = min(REFRESH_INTERVAL, max(0, Taskman.next_queue_poll - time.time()))
+            if Taskman.bucket is not None and Taskman.bucket.backlog:
+                timeout = 0
+            stages = watcher.wait(timeout) or {'bucket', 'jobs', 'logs'}
         except KeyboardInterrupt:
             command_mode = True
 
         if command_mode:
+            Taskman.screen.invalidate()
             print('\rUpdating, please wait...')
-            Taskman.update(resume_incomplete_tasks=False)
+            Taskman.update(resume_incomplete_tasks=False, stages={'jobs', 'logs'})
             _show_commands()
             command = input('\033[1mCommand>>\033[0m ')
             _handle_command(command)
+            Taskman.screen.invalidate()
+            stages = None  # The command may have changed anything
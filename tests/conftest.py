@@ -0,0 +1,15 @@
+import sys
+import tempfile
+from os import environ, makedirs
+from os.path import abspath, dirname
+
+# taskman reads its paths from the environment when it is imported: point them to a scratch $HOME
+HOME = tempfile.mkdtemp(prefix='taskman_test_')
+makedirs(HOME + '/taskman/old')
+makedirs(HOME + '/logs')
+environ['HOME'] = HOME
+environ['TASKMAN_CKPTS'] = HOME + '/ckpt'
+for name in ['TASKMAN_BUCKET', 'TASKMAN_METRICS', 'TASKMAN_SCHEDULER', 'TASKMAN_USE_SLURM', 'TASKMAN_SERIES',
+             'TASKMAN_CHAIN', 'TASKMAN_MAX_QUEUED', 'TASKMAN_CKPT_LINKS']:
+    environ.pop(name, None)
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
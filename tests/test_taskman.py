@@ -0,0 +1,737 @@
+import io
+import json
+import math
+import random
+import re
+import subprocess
+from os import makedirs
+from pathlib import Path
+
+import pytest
+
+import taskman
+from taskman import BucketSpool, CheckpointStore, Job, JobIndex, JobStatus, MoabScheduler, SeriesStore, \
+    SlurmScheduler, TaskDB, Taskman
+
+
+def make_job(task_id, name, status=JobStatus.Finished, report=None, moab_id='1'):
+    job = Job(task_id, name, moab_id, status, 'template', '')
+    job.report = report or {}
+    return job
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(taskman, 'LOG_BLOCK_SIZE', 7)
+
+
+# Log readers
+
+@pytest.mark.parametrize('block_size', [1, 7, 64 * 1024])
+def test_read_tail(monkeypatch, block_size):
+    monkeypatch.setattr(taskman, 'LOG_BLOCK_SIZE', block_size)
+    rng = random.Random(0)
+    for _ in range(200):
+        data = ''.join(rng.choice('ab\n') for _ in range(rng.randrange(40))).encode()
+        expected = data.split(b'\n')
+        if expected[-1] == b'':
+            expected.pop()
+        for n_lines in range(6):
+            assert Taskman.read_tail(io.BytesIO(data), len(data), n_lines) == (expected[-n_lines:] if n_lines else [])
+
+
+def test_read_tail_reads_only_the_end(monkeypatch):
+    data = b''.join(b'line %d\n' % i for i in range(100000))
+    monkeypatch.setattr(Taskman.metrics, 'log_bytes', 0)
+    assert Taskman.read_tail(io.BytesIO(data), len(data), 3) == [b'line 99997', b'line 99998', b'line 99999']
+    assert Taskman.metrics.log_bytes == taskman.LOG_BLOCK_SIZE
+
+
+def test_read_last_report(small_blocks):
+    data = b'a\n!taskman{"epoch": 1}\nfiller line\n!taskman{"epoch": 2}\nb\n!taskman{"epo'
+    line, offset = Taskman.read_last_report(io.BytesIO(data), 0, len(data))
+    assert line == b'!taskman{"epoch": 2}'
+    assert offset == data.rindex(b'\n') + 1  # The incomplete line is read again next time
+
+    line, offset = Taskman.read_last_report(io.BytesIO(data), offset, len(data))
+    assert line is None and offset == data.rindex(b'\n') + 1
+
+    data += b'ch": 3}\n'
+    line, _ = Taskman.read_last_report(io.BytesIO(data), offset, len(data))
+    assert json.loads(line[len(taskman.REPORT_PREFIX):]) == {'epoch': 3}
+
+
+# Queries
+
+@pytest.fixture
+def index():
+    jobs = [make_job('t0', 'sweep1_lr1', JobStatus.Finished, {'val_acc': 0.95, 'opt': 'adam'}),
+            make_job('t1', 'sweep1_lr2', JobStatus.Finished, {'val_acc': 0.5, 'opt': 'sgd'}),
+            make_job('t2', 'sweep2_lr1', JobStatus.Dead, {'val_acc': 0.99}),
+            make_job('t3', 'sweep10_lr1', JobStatus.Running, {}),
+            make_job('t4', 'lr=0.1', JobStatus.Lost, {'val_acc': 0.7})]
+    index = JobIndex()
+    for job in jobs:
+        index.add(job)
+    return index, {job.task_id: job for job in jobs}
+
+
+def select_ids(index, query, **kwargs):
+    index, jobs = index
+    return [job.task_id for job in index.select(jobs, query, columns={'val_acc', 'opt'}, **kwargs)]
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('sweep1_lr1', ['t0']),
+    ('sweep1*', ['t3', 't0', 't1']),
+    ('sweep?_lr1', ['t0', 't2']),
+    ('re:_lr1$', ['t0', 't2', 't3']),
+    ('sweep* status=Finished val_acc>0.9', ['t0']),
+    ('status=Dead,Lost', ['t2', 't4']),
+    ('sweep* status!=Running,Dead', ['t0', 't1']),
+    ('sweep* opt=adam', ['t0']),
+    ('sweep* opt!=adam', ['t3', 't1', 't2']),
+    ('val_acc>=0.7', ['t0', 't2', 't4']),
+    ('* sort:-val_acc', ['t2', 't0', 't4', 't1', 't3']),
+    ('* sort:val_acc limit:2', ['t1', 't4']),
+    ('* sort:-val_acc limit:2', ['t2', 't0']),
+    ('lr=0.1', ['t4']),  # Not a known column: a name
+    ('nothing*', []),
+])
+def test_select(index, query, expected):
+    assert select_ids(index, query) == expected
+
+
+def test_select_requires_a_name(index):
+    for query in ['', ' ', 'limit:5', 'status=Finished']:
+        with pytest.raises(ValueError):
+            select_ids(index, query, require_name=True)
+    assert len(select_ids(index, '')) == 5
+    assert select_ids(index, '* status=Dead', require_name=True) == ['t2']
+
+
+def test_command_errors_are_printed(task_db, monkeypatch, capsys):
+    monkeypatch.setattr(taskman.time, 'sleep', lambda seconds: None)
+    taskman._handle_command('cancel ')  # No name: nothing to cancel, but the monitor keeps running
+    assert 'Error in command' in capsys.readouterr().out
+
+
+def test_query_errors(index):
+    with pytest.raises(ValueError):
+        JobIndex.parse('sweep* val_acc')
+    with pytest.raises(re.error):
+        select_ids(index, 're:(')
+
+
+# Queue parsers
+
+def test_parse_squeue():
+    output = '4000001|R\n3000000_1|PD\n  4000002 | CG \n\nmalformed\n'
+    assert SlurmScheduler.parse_queue(output) == {'4000001': 'R', '3000000_1': 'PD', '4000002': 'CG'}
+
+
+def test_parse_showq():
+    output = ('<Data><Object>queue</Object><queue count="1" option="active"><job JobID="1"></job></queue>'
+              '<queue count="2" option="eligible"><job JobID="2"></job><job JobID="3"></job></queue>'
+              '<queue count="0" option="blocked"></queue></Data>')
+    assert MoabScheduler.parse_queue(output) == {'1': 'active', '2': 'eligible', '3': 'eligible'}
+
+
+def test_unreadable_scheduler_output_counts_as_a_failure(monkeypatch):
+    scheduler = MoabScheduler()
+    monkeypatch.setattr(Taskman, 'scheduler', scheduler)
+    monkeypatch.setattr(scheduler, 'run', lambda args, timeout=20: 'WARNING: cannot reach server\n<Data><queue')
+    commands, parse, _ = scheduler.queue_commands([])
+    assert Taskman.run_queue_commands(commands, parse) is None
+    assert Taskman.get_accounting(['1', '2']) == {}
+
+
+# Queue cache
+
+def test_queue_cache_is_shared_until_it_expires(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(taskman.time, 'time', lambda: now[0])
+    monkeypatch.setattr(taskman, 'QUEUE_CACHE_TTL', 30)
+    path = str(tmp_path / 'queue')
+    first, second = taskman.QueueCache(path), taskman.QueueCache(path)  # Two taskman processes
+    queries = []
+
+    def query(statuses):
+        return lambda: queries.append(statuses) or statuses
+
+    assert first.fetch(None, query({'1': 'R'}))['statuses'] == {'1': 'R'}
+    now[0] += 10
+    assert second.fetch(['1'], query({'1': 'PD'}))['statuses'] == {'1': 'R'}  # Taken by the first one
+    assert queries == [{'1': 'R'}]
+
+    now[0] += 30
+    assert second.fetch(['1'], query({'1': 'PD'}))['statuses'] == {'1': 'PD'}
+    assert first.fetch(None, query({'1': 'PD', '2': 'R'}))['ids'] is None  # Restricted to ['1']: not enough
+
+    now[0] += 30
+    assert first.fetch(None, query(None))['statuses'] == {'1': 'PD', '2': 'R'}  # Scheduler down: stale snapshot
+    assert taskman.QueueCache(str(tmp_path / 'other')).fetch(None, query(None)) is None
+
+
+# Bucket
+
+@pytest.fixture
+def bucket(task_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(taskman, 'BUCKET_SETTLE_TIME', 0)
+    submitted = []
+
+    def create_tasks(specs):
+        if specs[0][0] == 'missing':
+            raise FileNotFoundError('no template missing')
+        return [make_job(str(len(submitted) + i), name) for i, (_, _, name) in enumerate(specs)]
+
+    def enqueue(jobs, priority=0, bucket_lines=()):
+        task_db.add_pending(jobs, priority, bucket_lines)
+        submitted.extend((job.name, priority) for job in jobs)
+
+    monkeypatch.setattr(Taskman, 'create_tasks', staticmethod(create_tasks))
+    monkeypatch.setattr(Taskman, 'enqueue', staticmethod(enqueue))
+    makedirs(tmp_path / 'bucket')
+    return BucketSpool(str(tmp_path / 'bucket')), submitted
+
+
+def test_bucket_process(bucket, capsys):
+    spool, submitted = bucket
+    Path(spool.folder, 'lines').write_text('t;--a 1;a\n\nt;--a 2;b;5\nt;--a 1;a\nbad line\nmissing;x;c\nt;--a 3;d\n')
+    spool.process(2)
+    assert submitted == [('a', 0), ('b', 5)]
+    assert spool.backlog == 3
+    claimed = [p.name for p in Path(spool.claimed_folder).iterdir()]
+    assert claimed == [spool.owner + '.lines']
+
+    spool.process(10)
+    assert submitted == [('a', 0), ('b', 5), ('d', 0)]
+    assert spool.backlog == 0
+    assert list(Path(spool.claimed_folder).iterdir()) == []
+    rejected = Path(spool.folder, '.rejected').read_text()
+    assert 'bad line' in rejected and 'missing;x;c' in rejected
+    assert '2 bucket lines rejected' in capsys.readouterr().out
+    assert Taskman.db.conn.execute('SELECT COUNT(*) FROM bucket_lines').fetchone()[0] == 0
+
+
+def test_bucket_lines_queued_before_a_crash_are_done(bucket, monkeypatch):
+    spool, submitted = bucket
+    Path(spool.folder, 'lines').write_text('t;x;a\nt2;y;b\nt3;z;c\n')
+    enqueue = Taskman.enqueue
+
+    def crash(jobs, priority=0, bucket_lines=()):
+        enqueue(jobs, priority, bucket_lines)
+        if jobs[0].name == 'b':
+            raise KeyboardInterrupt  # Killed once the lines are in the submission queue
+
+    monkeypatch.setattr(Taskman, 'enqueue', staticmethod(crash))
+    with pytest.raises(KeyboardInterrupt):
+        spool.process(10)
+    monkeypatch.setattr(Taskman, 'enqueue', staticmethod(enqueue))
+    spool.process(10)
+    assert submitted == [('a', 0), ('b', 0), ('c', 0)]
+
+
+def test_bucket_takes_over_dead_claims(bucket):
+    spool, submitted = bucket
+    makedirs(spool.claimed_folder)
+    dead_owner = '{}:{}'.format(spool.host, 2 ** 22 + 1)  # Above the default pid_max: no such process
+    claimed = Path(spool.claimed_folder, dead_owner + '.lines')
+    claimed.write_text('t;x;a\nt;y;b\n')
+    Taskman.db.add_bucket_lines([(spool.file_key(str(claimed)), 0)])
+    spool.process(10)
+    assert submitted == [('b', 0)]
+    assert list(Path(spool.claimed_folder).iterdir()) == []
+
+
+# Report history
+
+def test_series_pads_new_columns_with_nan(tmp_path):
+    series = SeriesStore(str(tmp_path / 'series'))
+    log = tmp_path / 'job.o1'
+    log.write_text('!taskman{"a": 1, "time": 10}\nfiller\n')
+    assert series.ingest('t0', str(log)) == 1
+    with open(log, 'a') as f:
+        f.write('!taskman{"a": 2, "b": 5, "time": 20}\n')
+    assert series.ingest('t0', str(log)) == 1
+    columns = series.load('t0')
+    assert list(columns['a']) == [1, 2] and list(columns['time']) == [10, 20]
+    assert math.isnan(columns['b'][0]) and columns['b'][1] == 5
+
+
+def test_series_drops_interrupted_appends(tmp_path):
+    series = SeriesStore(str(tmp_path / 'series'))
+    log = tmp_path / 'job.o1'
+    log.write_text('!taskman{"a": 1, "time": 10}\n')
+    series.ingest('t0', str(log))
+    with open(series.column_file('t0', 1), 'ab') as f:
+        f.write(b'\0' * 12)  # Rows written before a crash, not in the index
+    with open(log, 'a') as f:
+        f.write('!taskman{"a": 3, "time": 30}\n')
+    series.ingest('t0', str(log))
+    assert list(series.load('t0')['a']) == [1, 3]
+
+
+# Scripts
+
+def test_compiled_template_substitutes_the_task_variables():
+    template = taskman.CompiledTemplate('#SBATCH --job-name=$TASKMAN_NAME\nrun $TASKMAN_ARGS --id $TASKMAN_ID\n'
+                                        'echo $TASKMAN_OTHER $TASKMAN_NAME\n', None)
+    job = Job('t0', 'sweep', None, None, 'template', '--lr 0.1 $HOME')
+    assert template.render(job) == '#SBATCH --job-name=sweep\nrun --lr 0.1 $HOME --id t0\necho $TASKMAN_OTHER sweep\n'
+
+
+def test_templates_are_compiled_again_when_they_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(taskman, 'SCRIPTS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(Taskman, 'templates', {})
+    template_file = tmp_path / 'train.sh'
+    template_file.write_text('train $TASKMAN_ARGS\n')
+    (tmp_path / 'taskman_post_exec.sh').write_text('echo done $TASKMAN_ID\n')
+    jobs = [Job('t{}'.format(i), 'sweep', None, None, 'train', '--seed {}'.format(i)) for i in range(2)]
+    script_files = Taskman.generate_scripts(jobs)
+    assert [Path(f).read_text() for f in script_files] == ['train --seed 0\necho done t0\n',
+                                                           'train --seed 1\necho done t1\n']
+    compiled = Taskman.templates['train']
+    assert Taskman.get_template('train') is compiled
+
+    template_file.write_text('train --fast $TASKMAN_ARGS\n')
+    assert Taskman.get_template('train') is not compiled
+    Taskman.generate_scripts(jobs[:1])
+    assert Path(script_files[0]).read_text() == 'train --fast --seed 0\necho done t0\n'
+
+
+# Checkpoints
+
+def test_checkpoint_store_shares_identical_files(tmp_path):
+    store = CheckpointStore(str(tmp_path / 'store'))
+    for name in ['a', 'b']:
+        makedirs(tmp_path / name / 'ckpt')
+        (tmp_path / name / 'ckpt' / 'model.pt').write_bytes(b'weights')
+    manifest = store.add(str(tmp_path / 'a' / 'ckpt'), 'a')
+    assert store.add(str(tmp_path / 'b' / 'ckpt'), 'b') == manifest == {'ckpt/model.pt': manifest['ckpt/model.pt']}
+    assert not (tmp_path / 'a' / 'ckpt').exists()
+    assert store.add(str(tmp_path / 'a' / 'ckpt'), 'a') == manifest  # Moved in already: from names.json
+
+    makedirs(tmp_path / 'job')
+    assert len(store.place(manifest, str(tmp_path / 'job'))) == 1
+    assert (tmp_path / 'job' / 'ckpt' / 'model.pt').read_bytes() == b'weights'
+
+
+@pytest.mark.parametrize('links', [False, True])
+def test_placed_checkpoints_are_private_unless_links_are_enabled(tmp_path, links):
+    store = CheckpointStore(str(tmp_path / 'store'), links)
+    (tmp_path / 'model.pt').write_bytes(b'weights')
+    manifest = store.add(str(tmp_path / 'model.pt'), 'model.pt')
+    for name in ['a', 'b']:
+        makedirs(tmp_path / name)
+        methods = store.place(manifest, str(tmp_path / name))
+        assert methods[0] in (['hardlink'] if links else ['reflink', 'copy'])
+    if not links:
+        (tmp_path / 'a' / 'model.pt').write_bytes(b'trained')  # Rewritten in place
+        assert (tmp_path / 'b' / 'model.pt').read_bytes() == b'weights'
+    assert Path(store.folder, manifest['model.pt']).read_bytes() == b'weights'
+
+
+def test_checkpoint_placed_once_is_moved_out_of_the_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(CheckpointStore, 'FICLONE', 0)  # No reflinks, like ext4 or NFS
+    store = CheckpointStore(str(tmp_path / 'store'))
+    (tmp_path / 'model.pt').write_bytes(b'weights')
+    manifest = store.add(str(tmp_path / 'model.pt'), 'model.pt')
+    makedirs(tmp_path / 'a')
+    assert store.place(manifest, str(tmp_path / 'a'), move=True) == ['move']
+    assert not Path(store.folder, manifest['model.pt']).exists()
+    (tmp_path / 'a' / 'model.pt').write_bytes(b'trained')  # The job owns it
+    with pytest.raises(FileNotFoundError):
+        store.add(str(tmp_path / 'model.pt'), 'model.pt')  # Not in the store anymore
+
+    assert store.copy_manifest(str(tmp_path / 'a'), str(tmp_path / 'b')) == ['copy']
+    assert (tmp_path / 'b' / 'model.pt').read_bytes() == b'trained'
+
+
+def test_checkpoint_store_rejects_missing_sources(tmp_path):
+    store = CheckpointStore(str(tmp_path / 'store'))
+    makedirs(tmp_path / 'empty')
+    for path in [tmp_path / 'typo', tmp_path / 'empty']:
+        with pytest.raises(FileNotFoundError):
+            store.add(str(path), path.name)
+    assert store.read_json(store.folder + '/names.json') == {}
+
+
+# Cleaning
+
+@pytest.fixture
+def task_db(tmp_path, monkeypatch):
+    db = TaskDB(str(tmp_path / 'tasks.db'))
+    monkeypatch.setattr(Taskman, 'db', db)
+    monkeypatch.setattr(Taskman, 'jobs', {})
+    monkeypatch.setattr(Taskman, 'index', JobIndex())
+    return db
+
+
+def test_clean_cancels_pre_queued_segments(task_db, monkeypatch):
+    jobs = [make_job('t0', 'seg', moab_id='10'), make_job('t1', 'seg', moab_id='11'),
+            make_job('t2', 'other', moab_id='12')]
+    task_db.add_started(jobs)
+    task_db.add_finished([('10', 'ok'), ('12', 'ok')])  # t1 is still running
+    task_db.add_chains([('t0', '10', '20'), ('t1', '11', '21'), ('t2', '12', '22')])
+    for job in jobs:
+        Taskman.jobs[job.task_id] = job
+        Taskman.index.add(job)
+    cancelled = []
+    monkeypatch.setattr(Taskman, 'cancel_continuations', staticmethod(cancelled.extend))
+
+    taskman._clean('seg')
+    assert cancelled == ['20']
+    assert task_db.get_chains() == {'t1': ('11', '21'), 't2': ('12', '22')}
+    with pytest.raises(ValueError):
+        taskman._clean(' ')
+
+
+# Task database
+
+def test_task_db_imports_the_started_file(tmp_path, monkeypatch):
+    started = tmp_path / 'started'
+    started.write_text('t0;a;10;template;--x 1\n\nt1;b;11;template;--x 2\n')
+    monkeypatch.setattr(taskman, 'DB_STARTED_TASKS', str(started))
+    db = TaskDB(str(tmp_path / 'tasks.db'))
+    _, rows = db.changed_since(0)
+    assert [r[:5] for r in rows] == [('t0', 'a', '10', 'template', '--x 1'), ('t1', 'b', '11', 'template', '--x 2')]
+    assert not started.exists() and (tmp_path / 'started.imported').exists()
+    assert TaskDB(str(tmp_path / 'tasks.db')).changed_since(0)[1] == rows  # Imported once
+
+
+def test_task_db_import_tolerates_a_concurrent_import(tmp_path, monkeypatch):
+    started = tmp_path / 'started'
+    started.write_text('t0;a;10;template;--x 1\n')
+    monkeypatch.setattr(taskman, 'DB_STARTED_TASKS', str(started))
+    real_rename = taskman.rename
+
+    def rename_after_other_process(src, dst):
+        real_rename(src, dst)  # The other process renamed the file first
+        real_rename(src, dst)
+
+    monkeypatch.setattr(taskman, 'rename', rename_after_other_process)
+    db = TaskDB(str(tmp_path / 'tasks.db'))
+    assert [r[0] for r in db.changed_since(0)[1]] == ['t0']
+    assert (tmp_path / 'started.imported').exists()
+
+
+def test_task_db_returns_the_rows_changed_since_a_revision(task_db, tmp_path, monkeypatch):
+    finished = tmp_path / 'finished'
+    monkeypatch.setattr(taskman, 'DB_FINISHED_TASKS', str(finished))
+    monkeypatch.setattr(taskman, 'DB_DEAD_TASKS', str(tmp_path / 'dead'))
+    task_db.add_started([make_job('t0', 'a', moab_id='10'), make_job('t1', 'b', moab_id='11')])
+    rev, rows = task_db.changed_since(0)
+    assert [r[0] for r in rows] == ['t0', 't1'] and task_db.changed_since(rev) == (rev, [])
+
+    finished.write_text('11,b,ok\n10,a')  # The last line is still being written
+    task_db.sync_outcomes()
+    rev, rows = task_db.changed_since(rev)
+    assert rows == [('t1', 'b', '11', 'template', '', 0, 1, 'ok', 0, None)]
+    with open(finished, 'a') as f:
+        f.write(',cancel\n')
+    task_db.sync_outcomes()
+    rev, rows = task_db.changed_since(rev)
+    assert [(r[0], r[7]) for r in rows] == [('t0', 'cancel')]
+
+    generation = task_db.generation()
+    assert [r[0] for r in task_db.remove(['t1'])] == ['t1']
+    assert task_db.generation() == generation + 1  # Readers reload everything
+    assert [r[0] for r in task_db.changed_since(0)[1]] == ['t0']
+
+
+# Refresh
+
+@pytest.mark.parametrize('stages, expected', [
+    ({'logs'}, ['logs', 'render', 'resume']),
+    ({'jobs'}, ['admit', 'jobs', 'render', 'resume']),
+    ({'bucket'}, ['bucket', 'admit', 'jobs', 'render', 'resume']),
+    (None, ['bucket', 'queue', 'admit', 'jobs', 'logs', 'render', 'resume']),
+])
+def test_update_runs_the_affected_stages(monkeypatch, stages, expected):
+    ran = []
+    for stage, method in [('bucket', 'process_bucket'), ('queue', 'get_queue'), ('admit', 'admit'),
+                          ('jobs', 'sync_job_list'), ('logs', 'update_report'), ('render', 'show_status'),
+                          ('resume', 'resume_incomplete_tasks')]:
+        monkeypatch.setattr(Taskman, method, staticmethod(lambda *args, stage=stage: ran.append(stage)))
+    monkeypatch.setattr(Taskman, 'set_queue', staticmethod(lambda statuses: None))
+    monkeypatch.setattr(Taskman, 'next_queue_poll', float('inf'))
+    Taskman.update(stages=stages)
+    assert ran == expected
+
+
+@pytest.mark.parametrize('mode', ['auto', 'poll'])
+def test_watcher_ignores_the_writes_of_this_process(task_db, tmp_path, monkeypatch, mode):
+    monkeypatch.setattr(taskman, 'WATCH_MODE', mode)
+    monkeypatch.setattr(taskman, 'WATCH_POLL_INTERVAL', 0)
+    monkeypatch.setattr(taskman, 'DB_FINISHED_TASKS', str(tmp_path / 'taskman' / 'finished'))
+    monkeypatch.setattr(taskman, 'HOMEDIR', str(tmp_path))
+    makedirs(tmp_path / 'taskman')
+    makedirs(tmp_path / 'logs')
+    watcher = taskman.ChangeWatcher(task_db)
+    taskman.QueueCache(str(tmp_path / 'taskman' / 'queue')).write({}, None)
+    task_db.add_started([make_job('t0', 'a')])
+    assert watcher.changes() == set()
+
+    TaskDB(str(tmp_path / 'tasks.db')).add_started([make_job('t1', 'b')])  # Another taskman process
+    assert watcher.changes() == {'jobs'}
+    watcher.last_fired.clear()
+    with open(taskman.DB_FINISHED_TASKS, 'a') as f:
+        f.write('2,b,ok\n')
+    assert watcher.changes() == {'jobs'}
+
+
+def test_jobs_refresh_resumes_from_the_final_report(task_db, monkeypatch):
+    for name, value in [('active_jobs', {}), ('log_cursors', {}), ('columns', set()), ('frozen_columns', set()),
+                        ('db_rev', 0), ('db_generation', None), ('next_queue_poll', float('inf'))]:
+        monkeypatch.setattr(Taskman, name, value)
+    monkeypatch.setattr(Taskman, 'show_status', staticmethod(lambda: None))
+    enqueued = []
+    monkeypatch.setattr(Taskman, 'enqueue', staticmethod(lambda jobs, priority=0: enqueued.extend(jobs)))
+    task_db.add_started([make_job('t0', 'final_report', moab_id='10')])
+    log = Path(taskman.HOMEDIR, 'logs', 'final_report.o10')
+    log.write_text('!taskman{"resubmit": true}\n')
+    monkeypatch.setattr(Taskman, 'statuses', {'10': 'R'})
+    Taskman.update(stages={'jobs', 'logs'})
+    assert Taskman.jobs['t0'].report == {'resubmit': True}
+
+    with open(log, 'a') as f:
+        f.write('!taskman{"resubmit": false}\n')
+    task_db.add_finished([('10', 'ok')])
+    monkeypatch.setattr(Taskman, 'statuses', {})
+    Taskman.update(stages={'jobs'})  # The scan of the logs is held back
+    assert Taskman.jobs['t0'].report == {'resubmit': False} and enqueued == []
+
+
+def test_ended_jobs_are_frozen_once_their_log_stops_growing(monkeypatch):
+    jobs = {'t0': make_job('t0', 'frozen', moab_id='20'), 't1': make_job('t1', 'frozen', moab_id='21'),
+            't2': make_job('t2', 'frozen', JobStatus.Running, moab_id='22')}
+    for name, value in [('active_jobs', dict(jobs)), ('log_cursors', {}), ('columns', set()),
+                        ('frozen_columns', set())]:
+        monkeypatch.setattr(Taskman, name, value)
+    logs = {task_id: Path(taskman.HOMEDIR, 'logs', 'frozen.o' + job.moab_id) for task_id, job in jobs.items()}
+    logs['t0'].write_text('!taskman{"acc": 0.5}\n')
+    logs['t1'].write_text('!taskman{"loss": 1, "resubmit": true}\n')
+    logs['t2'].write_text('!taskman{"epoch": 1}\n')
+    Taskman.update_report()
+    assert list(Taskman.active_jobs) == ['t0', 't1', 't2']  # Their logs were just read
+
+    Taskman.update_report()
+    assert list(Taskman.active_jobs) == ['t1', 't2']  # t1 is about to be resubmitted
+    assert jobs['t0'].frozen and not jobs['t1'].frozen and not jobs['t2'].frozen
+    assert Taskman.frozen_columns == {'acc'} and Taskman.columns == {'acc', 'loss', 'resubmit', 'epoch'}
+    assert set(Taskman.log_cursors) == {str(logs['t1']), str(logs['t2'])}
+
+    with open(logs['t0'], 'a') as f:
+        f.write('!taskman{"acc": 0.9}\n')
+    Taskman.update_report()
+    assert jobs['t0'].report == {'acc': 0.5}
+
+
+@pytest.mark.parametrize('column, reverse, expected', [
+    ('acc', False, ['n1', 'n2', 'n3', 'n0']),
+    ('acc', True, ['n2', 'n1', 'n3', 'n0']),
+    ('updated', False, ['n2', 'n1', 'n0', 'n3']),  # Most recent first
+    ('updated', True, ['n1', 'n2', 'n0', 'n3']),
+])
+def test_dashboard_sort_puts_missing_values_last(column, reverse, expected):
+    jobs = [make_job('n0', 'n0'), make_job('n1', 'n1', report={'acc': 0.1, 'time': 10}),
+            make_job('n2', 'n2', report={'acc': 0.9, 'time': 20}), make_job('n3', 'n3', report={'acc': 'n/a'})]
+    screen = taskman.Screen()
+    screen.sort_column, screen.reverse = column, reverse
+    assert [job.name for job in sorted(jobs, key=screen.sort_key(), reverse=screen.reverse)] == expected
+
+
+# Admission
+
+def test_capped_queue_counts_all_user_jobs(monkeypatch):
+    monkeypatch.setattr(Taskman, 'active_jobs', {'t0': make_job('t0', 'a', JobStatus.Running, moab_id='10')})
+    commands, _, ids = SlurmScheduler().queue_commands(Taskman.queue_ids())
+    assert ids == ['10'] and len(commands) == 2  # Only the tracked jobs without a cap
+
+    monkeypatch.setattr(taskman, 'MAX_QUEUED', 3)
+    commands, _, ids = SlurmScheduler().queue_commands(Taskman.queue_ids())
+    assert ids is None and len(commands) == 1 and commands[0][-1].startswith('--user=')
+    monkeypatch.setattr(Taskman, 'statuses', {'10': 'R', '20': 'PD'})  # 20 is a pre-queued segment
+    monkeypatch.setattr(Taskman, 'queue_time', 0)
+    monkeypatch.setattr(Taskman, 'recent_submissions', {})
+    assert Taskman.queue_capacity() == 1
+
+
+def test_queue_polling_backs_off_only_without_live_jobs(monkeypatch):
+    monkeypatch.setattr(Taskman, 'queue_backoff', taskman.Backoff(30, 600))
+    monkeypatch.setattr(Taskman, 'statuses', None)
+    monkeypatch.setattr(Taskman, 'active_jobs', {'t0': make_job('t0', 'a', JobStatus.Running, moab_id='10')})
+    for _ in range(6):
+        Taskman.set_queue({'10': 'R'})
+    assert Taskman.next_queue_poll <= taskman.time.time() + taskman.REFRESH_INTERVAL
+
+    Taskman.active_jobs['t0'].status = JobStatus.Finished
+    for _ in range(4):
+        Taskman.set_queue({})
+    assert Taskman.next_queue_poll > taskman.time.time() + taskman.REFRESH_INTERVAL
+
+def test_jobs_submitted_after_the_cached_snapshot_are_not_lost(task_db, tmp_path, monkeypatch):
+    for name, value in [('active_jobs', {}), ('log_cursors', {}), ('columns', set()), ('frozen_columns', set()),
+                        ('db_rev', 0), ('db_generation', None), ('statuses', None), ('next_queue_poll', 0),
+                        ('queue_min_time', 0), ('recent_submissions', {}), ('accounting', {}),
+                        ('accounting_misses', {}), ('queue_backoff', taskman.Backoff(120, 600)),
+                        ('queue_cache', taskman.QueueCache(str(tmp_path / 'queue')))]:
+        monkeypatch.setattr(Taskman, name, value)
+    monkeypatch.setattr(taskman, 'MAX_QUEUED', 10)  # The whole user queue is cached
+    monkeypatch.setattr(Taskman, 'show_status', staticmethod(lambda: None))
+    scheduler = SlurmScheduler()
+    monkeypatch.setattr(Taskman, 'scheduler', scheduler)
+    queue, calls = [], []
+
+    def run(args, timeout=20):
+        calls.append(args[0])
+        if args[0] == 'sbatch':
+            queue.append('101|PD')
+            return 'Submitted batch job 101\n'
+        return '\n'.join(queue) if args[0] == 'squeue' else ''
+
+    monkeypatch.setattr(scheduler, 'run', run)
+    task_db.add_pending([make_job('t0', 'a', moab_id='')], 0)
+    Taskman.update(resume_incomplete_tasks=False, stages={'jobs'})  # Polls the empty queue, then submits
+    assert calls == ['squeue', 'sbatch'] and Taskman.jobs['t0'].status == JobStatus.Waiting
+
+    Taskman.update(resume_incomplete_tasks=False, stages={'jobs'})
+    assert calls == ['squeue', 'sbatch', 'squeue'] and Taskman.statuses == {'101': 'PD'}
+    assert Taskman.jobs['t0'].status == JobStatus.Waiting and Taskman.accounting_misses == {}
+
+def test_queued_tasks_are_claimed_by_one_process(task_db, tmp_path):
+    other_db = TaskDB(str(tmp_path / 'tasks.db'))  # Another taskman process
+    task_db.add_pending([make_job('t0', 'a', moab_id=''), make_job('t1', 'b', moab_id='')], 0)
+    assert [r[0] for r in task_db.claim_pending(100, -1)] == ['t0', 't1']
+    assert other_db.claim_pending(100, -1) == []
+
+    task_db.add_started([make_job('t0', 'a', moab_id='10')])
+    task_db.retry_pending({'t1': 'error'}, 100)
+    assert other_db.claim_pending(100, -1) == []
+    assert [r[0] for r in other_db.claim_pending(100 + taskman.QUEUE_MIN_INTERVAL, -1)] == ['t1']
+    assert task_db.claim_pending(100 + taskman.SUBMIT_LEASE, -1) == []  # Claimed again: the lease restarted
+
+
+def test_submission_is_given_up_after_too_many_attempts(task_db, monkeypatch):
+    monkeypatch.setattr(taskman, 'SUBMIT_ATTEMPTS', 2)
+    task_db.add_pending([make_job('t0', 'a', moab_id='')], 0)
+    task_db.claim_pending(0, -1)
+    assert task_db.retry_pending({'t0': 'first'}, 0) == []
+    assert task_db.count_pending() == 1
+    task_db.claim_pending(taskman.QUEUE_MAX_INTERVAL, -1)
+    assert task_db.retry_pending({'t0': 'Invalid account'}, 0) == ['t0']
+    assert task_db.count_pending() == 0
+    assert task_db.claim_pending(10 ** 9, -1) == []
+    _, rows = task_db.changed_since(0)
+    assert [r[-2:] for r in rows] == [(0, 'Invalid account')]
+
+    task_db.add_pending([make_job('t0', 'a', moab_id='')], 0)  # Queued again
+    assert [r[0] for r in task_db.claim_pending(0, -1)] == ['t0']
+    _, rows = task_db.changed_since(0)
+    assert [r[-2:] for r in rows] == [(1, None)]
+
+
+def test_jobs_with_the_same_directives_share_a_job_array(task_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(taskman, 'SCRIPTS_FOLDER', str(tmp_path / 'scripts'))
+    monkeypatch.setattr(taskman, 'JOB_ARRAYS', True)
+    monkeypatch.setattr(Taskman, 'queue_changed', staticmethod(lambda: None))
+    scheduler = SlurmScheduler()
+    monkeypatch.setattr(Taskman, 'scheduler', scheduler)
+
+    def run(args, timeout=20):
+        if '--partition=bad' in Path(args[-1]).read_text():
+            raise subprocess.CalledProcessError(1, args, b'sbatch: error: invalid partition\n')
+        return 'Submitted batch job {}\n'.format(100 if '--array=0-2' in args else 200)
+
+    monkeypatch.setattr(scheduler, 'run', run)
+    jobs = []
+    for i, directive in enumerate(['--time=1:00', '--time=1:00', '--time=1:00', '--partition=bad', '--time=2:00']):
+        job = make_job('t{}'.format(i), 'sweep', moab_id='')
+        makedirs(Path(job.script_file).parent, exist_ok=True)
+        Path(job.script_file).write_text('#!/bin/bash\n#SBATCH {}\necho {}\n'.format(directive, i))
+        jobs.append(job)
+
+    errors = {}
+    submitted = Taskman.submit_many(jobs, errors)
+    assert [(j.task_id, j.moab_id) for j in submitted] == [('t0', '100_0'), ('t1', '100_1'), ('t2', '100_2'),
+                                                           ('t4', '200')]
+    assert errors == {'t3': 'sbatch: error: invalid partition'}
+    array_script = Path(jobs[0].script_file).parent.joinpath('array_t0.sh').read_text()
+    assert '#SBATCH --time=1:00' in array_script and 'exec bash ' + jobs[2].script_file in array_script
+    rev, rows = task_db.changed_since(0)
+    assert rev == 1 and sorted(r[2] for r in rows) == ['100_0', '100_1', '100_2', '200']  # One write
+
+
+def test_follow_chains_promotes_or_cancels_the_next_segments(task_db, monkeypatch):
+    monkeypatch.setattr(Taskman, 'queue_changed', staticmethod(lambda: None))
+    cancelled = []
+    monkeypatch.setattr(Taskman, 'cancel_continuations', staticmethod(cancelled.extend))
+    jobs = [make_job('t0', 'go', report={'resubmit': True}, moab_id='10'),
+            make_job('t1', 'stop', report={'resubmit': False}, moab_id='11'),
+            make_job('t2', 'died', JobStatus.Dead, report={'resubmit': True}, moab_id='12'),
+            make_job('t3', 'running', JobStatus.Running, report={'resubmit': True}, moab_id='13'),
+            make_job('t4', 'cancelled', report={'resubmit': True}, moab_id='14'),
+            make_job('t5', 'last', JobStatus.Running, report={'resubmit': False}, moab_id='15')]
+    jobs[4].finish_msg = 'cancel'
+    task_db.add_started(jobs)
+    task_db.add_chains([('t{}'.format(i), '1{}'.format(i), '2{}'.format(i)) for i in range(7)])  # t6 was removed
+    Taskman.jobs.update({job.task_id: job for job in jobs})
+
+    assert Taskman.follow_chains() == [jobs[0]]
+    assert (jobs[0].moab_id, jobs[0].prev_moab_id, jobs[0].status) == ('20', '10', JobStatus.Waiting)
+    assert sorted(cancelled) == ['21', '22', '24', '25', '26']
+    assert task_db.get_chains() == {'t3': ('13', '23')}
+    assert [r[2] for r in task_db.changed_since(0)[1] if r[0] == 't0'] == ['20']
+
+
+# Results
+
+def test_merged_moments_match_direct_computation():
+    rng = random.Random(0)
+    values = [rng.gauss(3, 2) for _ in range(100)]
+    merged = None
+    for i in range(0, 100, 17):
+        merged = taskman._merge_moments(merged, taskman._column_moments(str(v) for v in values[i:i + 17]))
+    direct = taskman._column_moments(values)
+    assert merged[0] == direct[0] == 100 and merged[3:] == direct[3:]
+    assert merged[1] == pytest.approx(direct[1]) and merged[2] == pytest.approx(direct[2])
+    assert taskman._column_moments(['x', 'nan', '']) is None
+
+
+def test_results_append_only_new_tasks(task_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(taskman, 'CKPT_FOLDER', str(tmp_path / 'ckpt'))
+    monkeypatch.setattr(taskman, 'RESULTS_FOLDER', str(tmp_path / 'results'))
+    monkeypatch.setattr('builtins.input', lambda prompt='': '')
+    parsed = []
+    read_result_table = Taskman.read_result_table
+    monkeypatch.setattr(Taskman, 'read_result_table',
+                        staticmethod(lambda job: parsed.append(job.task_id) or read_result_table(job)))
+
+    def add_task(task_id, rows):
+        job = make_job(task_id, 'res')
+        Taskman.jobs[task_id] = job
+        Taskman.index.add(job)
+        makedirs(tmp_path / 'ckpt' / 'res' / task_id)
+        (tmp_path / 'ckpt' / 'res' / task_id / 'results.csv').write_text('acc,loss\n' + rows)
+
+    add_task('t0', '1,5\n2,6\n')
+    add_task('t1', '3,7\n')
+    taskman.results('res*')
+    assert sorted(parsed) == ['t0', 't1']  # Summarized and merged in one read
+
+    parsed.clear()
+    add_task('t2', '4,x\n')
+    taskman.results('res*')
+    assert parsed == ['t2']
+    merged = (tmp_path / 'results' / 'res.csv').read_text().splitlines()
+    assert merged == ['task_name,task_id,args,acc,loss', 'res,t0,,1,5', 'res,t0,,2,6', 'res,t1,,3,7', 'res,t2,,4,x']
+    stats = (tmp_path / 'results' / 'res_stats.csv').read_text().splitlines()
+    assert stats[1].split(',')[:5] == ['res', 'acc', '3', '4', '2.5'] and stats[2].split(',')[:5] == \
+        ['res', 'loss', '3', '3', '6.0']
+
+    parsed.clear()
+    (tmp_path / 'ckpt' / 'res' / 't0' / 'results.csv').write_text('acc,loss\n9,9\n')
+    taskman.results('res*')
+    assert sorted(parsed) == ['t0', 't1', 't2']  # A merged task changed: rewritten, each file read once
+    assert (tmp_path / 'results' / 'res.csv').read_text().splitlines()[1:2] == ['res,t0,,9,9']